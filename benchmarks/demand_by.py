@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of demand_by against the loop version.
+
+The loop version is the implementation before demand_by was computed as one
+broadcasted product. Both versions are run on the same building table and
+the results are compared. By default a synthetic table with the number of
+buildings of the OEQ table of Berlin is used. With the option --oeq the OEQ
+results of Berlin are loaded (see heat.load_heat_data), which needs the
+openEQuarter results file.
+
+Run: python benchmarks/demand_by.py [--oeq]
+
+SPDX-FileCopyrightText: 2016-2019 Uwe Krien <krien@uni-bremen.de>
+
+SPDX-License-Identifier: MIT
+"""
+__copyright__ = "Uwe Krien <krien@uni-bremen.de>"
+__license__ = "MIT"
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from berlin_hp import heat
+
+# Number of buildings of the OEQ table of Berlin
+OEQ_BUILDINGS = 550000
+
+
+def demand_by_loop(data, demand_column, heating_systems, building_types,
+                   remove_string='', prz=1):
+    """demand_by with one query and combine_first per building type."""
+    demand_by_building = pd.DataFrame(index=data.index)
+    for btype, condition in building_types.items():
+        demand_by_building.loc[data.query(condition).index, btype] = (
+            data[demand_column][data.query(condition).index])
+
+    demand = pd.DataFrame(index=data.index)
+    blist = list()
+    for btype in demand_by_building.keys():
+        rename_dict = {
+            col: 'demand_' + btype + '_' + col.replace(remove_string, '')
+            for col in heating_systems}
+        demand = demand.combine_first(
+            data[heating_systems].multiply(
+                demand_by_building[btype], axis='index').div(prz))
+        demand = demand.rename(columns=rename_dict)
+        blist.extend(list((btype, )) * len(heating_systems))
+    hlist = heating_systems * len(set(blist))
+    multindex = pd.MultiIndex.from_tuples(list(zip(blist, hlist)),
+                                          names=['first', 'second'])
+    return pd.DataFrame(data=demand.values, columns=multindex,
+                        index=data.index)
+
+
+def create_buildings(number, seed=0):
+    """Synthetic building table with the columns of the OEQ table that are
+    used by demand_by."""
+    rng = np.random.default_rng(seed)
+    fractions = rng.random((number, 5)) * 100
+    data = pd.DataFrame(
+        fractions,
+        columns=['frac_elec', 'frac_district_heating', 'frac_gas',
+                 'frac_oil', 'frac_coal'])
+    data['floors'] = rng.integers(1, 6, number)
+    data['total_loss_pres'] = rng.random(number) * 1e5
+    data.loc[rng.random(number) < 0.05, 'total_loss_pres'] = np.nan
+    data.index = ['building_{0}'.format(n) for n in range(number)]
+    return data
+
+
+def timed(function, *args, repeat=3):
+    """Mean duration and the result of a function."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def benchmark_demand_by(data):
+    # combine_first sorts the columns, so the loop version is only correct
+    # for sorted heating systems.
+    heating_systems = sorted(c for c in data.columns if 'frac_' in c)
+    for building_types in [None, {'efh': 'floors < 2', 'mfh': 'floors > 1'}]:
+        types = building_types or {'all': 'total_loss_pres == '
+                                          'total_loss_pres'}
+        loop, a = timed(demand_by_loop, data, 'total_loss_pres',
+                        heating_systems, types, 'frac_')
+        array, b = timed(heat.demand_by, data, 'total_loss_pres',
+                         heating_systems, building_types, 'frac_')
+        # The loop version does not rename the heating systems.
+        names = pd.MultiIndex.from_product(
+            [list(types), [c.replace('frac_', '') for c in heating_systems]])
+        equal = (list(b.columns) == list(names) and
+                 np.allclose(a.values, b.values, equal_nan=True))
+        print("demand_by ({0} types, {1} buildings) loop {2:7.3f} s, "
+              "array {3:7.3f} s, speed-up {4:5.1f}, equal: {5}".format(
+                  len(types), len(data), loop, array, loop / array, equal))
+
+
+if __name__ == "__main__":
+    if '--oeq' in sys.argv:
+        buildings = heat.load_heat_data(fill_frac_column=False)
+    else:
+        buildings = create_buildings(OEQ_BUILDINGS)
+    benchmark_demand_by(buildings)
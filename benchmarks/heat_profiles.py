@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of get_annual_heat_demand and create_heat_profiles against the
+loop version.
+
+The loop version is the implementation of create_heat_profiles before the
+absolute demand of each fuel and sector and the heat profiles were computed
+as array products. Both versions are run on the same synthetic building
+table with the number of buildings of Berlin and the results are compared.
+
+Only the sources are replaced by synthetic tables: the building table (see
+get_building_data), the energy balance and the BMWi sheets (see
+berlin_hp.balance) and the normalised heat load profiles, which need the
+weather data. The scaling to the energy balance, the building x fuel x
+sector matrix and the profiles are calculated by the real functions. The
+config of berlin_hp is used (small shares, district heating systems).
+
+Run: python benchmarks/heat_profiles.py
+
+SPDX-FileCopyrightText: 2016-2019 Uwe Krien <krien@uni-bremen.de>
+
+SPDX-License-Identifier: MIT
+"""
+__copyright__ = "Uwe Krien <krien@uni-bremen.de>"
+__license__ = "MIT"
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from reegis import config as cfg
+import berlin_hp.balance
+from berlin_hp import heat
+
+# Number of buildings of the OEQ table of Berlin
+BUILDINGS = 550000
+
+YEAR = 2014
+
+
+def get_annual_heat_demand_loop(year, data):
+    """Annual heat demand with one column insertion per fuel and sector."""
+    end_energy_table = berlin_hp.balance.get_heat_demand(year, 'BE')
+    tab_a = berlin_hp.balance.get_bmwi_sheet_7('a')
+    tab_b = berlin_hp.balance.get_bmwi_sheet_7('b')
+
+    heat_process = {}
+    p = 'sonstige Prozesswärme'
+    r = 'Raumwärme'
+    w = 'Warmwasser'
+    for key, s, tab in [('domestic', 'private Haushalte', tab_b),
+                        ('retail', 'Gewerbe, Handel, Dienstleistungen ',
+                         tab_b),
+                        ('industrial', 'Industrie', tab_a)]:
+        heat_process[key] = (tab.loc[(s, p, p), year] / (
+            tab.loc[(s, p, p), 2014] +
+            tab.loc[(s, r, r), 2014] +
+            tab.loc[(s, w, w), 2014]))
+
+    profile_type = pd.DataFrame(columns=end_energy_table.columns)
+    profile_type.loc['process'] = 0
+    profile_type.loc['building'] = 0
+    for key in end_energy_table.index:
+        profile_type.loc['process'] += (
+                end_energy_table.loc[key] * heat_process[key] / 3.6 * 1000000)
+        profile_type.loc['building'] += (
+                end_energy_table.loc[key] * (1 - heat_process[key]) /
+                3.6 * 1000000)
+
+    for pt in profile_type.index:
+        s = profile_type.loc[pt].sum()
+        r = 0
+        for col in profile_type.columns:
+            if profile_type.loc[pt, col] / s < cfg.get('heating',
+                                                       'small_share'):
+                r += profile_type.loc[pt, col]
+                profile_type.loc[pt, col] = 0
+        s = profile_type.loc[pt].sum()
+        profile_type.loc[pt] = (
+                profile_type.loc[pt] + profile_type.loc[pt].div(s).multiply(r))
+
+    fuels = []
+
+    frac_cols = [x for x in data.columns if 'frac_' in x]
+    two_level_columns = pd.MultiIndex(levels=[[], []], codes=[[], []])
+    abs_data = pd.DataFrame(index=data.index, columns=two_level_columns)
+    for col in frac_cols:
+        for t in ['ghd', 'mfh']:
+            c = col.replace('frac_', '').replace('_', ' ').replace(
+                'gas', 'natural gas')
+            abs_data[c, t] = data[col].multiply(data['total'] *
+                                                data[t], axis=0)
+
+    factor = {'elec': (profile_type.loc['building'].sum() /
+                       abs_data.sum().sum())}
+    for fuel in abs_data.columns.get_level_values(0).unique():
+        if fuel not in factor and fuel in profile_type.columns:
+            factor[fuel] = (profile_type.loc['building', fuel] /
+                            abs_data[fuel].sum().sum())
+        elif fuel not in factor and fuel not in profile_type.columns:
+            factor[fuel] = 0
+
+        abs_data[fuel] *= factor[fuel]
+        if abs_data[fuel].sum().sum() > 0:
+            fuels.append(fuel)
+
+    for fuel in fuels:
+        if fuel in profile_type.columns:
+            abs_data[fuel, 'proc'] = (
+                profile_type.loc['process', fuel] / len(abs_data))
+    return abs_data, fuels
+
+
+def create_heat_profiles_loop(year, region, data, distr_heat_areas):
+    """create_heat_profiles with one column insertion per fuel and sector.
+
+    The building table and the district heating areas are the tables of
+    get_building_data.
+    """
+    district_heating_groups = cfg.get_dict('district_heating_systems')
+    abs_data, fuels = get_annual_heat_demand_loop(year, data)
+
+    shlp = {'ghd': {'build_class': 0},
+            'mfh': {'build_class': 1}}
+    norm_heat_profiles = heat.create_standardised_heat_load_profile(
+        shlp, year)
+    norm_heat_profiles['proc'] = 1000 / len(norm_heat_profiles)
+
+    two_level_columns = pd.MultiIndex(levels=[[], []], codes=[[], []])
+    heat_profiles = pd.DataFrame(index=norm_heat_profiles.index,
+                                 columns=two_level_columns)
+
+    if region != 'berlin':
+        abs_data = abs_data.loc[data.lor.str.startswith(str(region))]
+
+    for fuel in fuels:
+        for sector in abs_data[fuel].columns:
+            heat_profiles[fuel, sector] = norm_heat_profiles[sector].multiply(
+                abs_data[fuel, sector].sum())
+
+    # Only the used column is summed up, the other columns contain text.
+    district_by_stift = data.loc[
+        abs_data.index, ['STIFT', 'frac_district_heating']].groupby(
+            'STIFT').sum()
+
+    stift2name = distr_heat_areas.groupby(
+        ['STIFT', 'KLASSENNAM']).size().reset_index(
+            level='KLASSENNAM')['KLASSENNAM']
+    stift2name[0] = 'unknown'
+
+    district_groups = pd.DataFrame(
+        pd.concat([district_by_stift, stift2name], axis=1)).set_index(
+            'KLASSENNAM').groupby(by=district_heating_groups).sum()
+
+    frac_district_groups = district_groups.div(district_groups.sum())
+
+    for nr in frac_district_groups.index:
+        for sector in heat_profiles['district heating'].columns:
+            heat_profiles[nr, sector] = (
+                heat_profiles['district heating', sector] *
+                frac_district_groups.loc[nr, 'frac_district_heating'])
+
+    heat_profiles = heat_profiles.groupby(level=0, axis=1).sum()
+    del heat_profiles['district heating']
+
+    for c in heat_profiles.columns:
+        if heat_profiles[c].sum() == 0:
+            del heat_profiles[c]
+
+    return heat_profiles.div(1000000)
+
+
+def create_buildings(number, seed=0):
+    """Synthetic building table like the table of get_building_data."""
+    rng = np.random.default_rng(seed)
+    lor = (rng.integers(1, 13, number) * 10 ** 6 +
+           rng.integers(1, 3, number) * 10 ** 4 +
+           rng.integers(1, 4, number) * 10 ** 2 +
+           rng.integers(1, 3, number))
+    fractions = rng.random((number, 5))
+    fractions /= fractions.sum(axis=1, keepdims=True)
+    data = pd.DataFrame(
+        fractions,
+        columns=['frac_elec', 'frac_district_heating', 'frac_gas',
+                 'frac_oil', 'frac_coal'])
+    data['lor'] = lor.astype(str)
+    data['lor_code'] = lor
+    data['total'] = rng.random(number) * 1e5
+    data.loc[rng.random(number) < 0.05, 'total'] = np.nan
+    data['ghd'] = rng.random(number)
+    data['mfh'] = 1 - data['ghd']
+    data['STIFT'] = rng.choice([0, 1, 2, 3], number)
+    data.index = ['building_{0}'.format(n) for n in range(number)]
+    return data.sort_values('lor_code', kind='mergesort')
+
+
+def create_sources(data, year=YEAR):
+    """Synthetic source tables of get_annual_heat_demand and
+    create_heat_profiles."""
+    distr_heat_areas = pd.DataFrame({
+        'STIFT': [1, 2, 3],
+        'KLASSENNAM': ['FL_HWNK', 'LTG_FW_BTB', 'FL_RWE_Gropius']})
+    lor_index = heat.create_lor_index(data['lor_code'].values)
+
+    # End energy for heating (TJ) by sector and fuel
+    end_energy = pd.DataFrame(
+        [[500, 9000, 20000, 8000, 300, 2000],
+         [200, 4000, 12000, 3000, 100, 500],
+         [100, 1000, 6000, 500, 50, 400]],
+        index=['domestic', 'retail', 'industrial'],
+        columns=['coal', 'district heating', 'natural gas', 'oil', 'other',
+                 're'], dtype=float)
+
+    # Sheet 7 of the BMWi energy data (process heat, space heat, hot water)
+    p = 'sonstige Prozesswärme'
+    r = 'Raumwärme'
+    w = 'Warmwasser'
+    sectors = ['private Haushalte', 'Gewerbe, Handel, Dienstleistungen ',
+               'Industrie']
+    index = pd.MultiIndex.from_tuples(
+        [(s, u, u) for s in sectors for u in (p, r, w)])
+    sheet = pd.DataFrame(
+        np.array([[5, 70, 15], [10, 60, 10], [60, 20, 2]]).reshape(-1, 1) *
+        np.array([[1.0, 0.98, 1.02]]),
+        index=index, columns=[2014, 2015, 2016])
+
+    index = pd.date_range(str(year), periods=8760, freq='H')
+    rng = np.random.default_rng(1)
+    norm_heat_profiles = pd.DataFrame(
+        {s: rng.random(len(index)) for s in ['ghd', 'mfh']}, index=index)
+    norm_heat_profiles = norm_heat_profiles.div(norm_heat_profiles.sum())
+    norm_heat_profiles *= 1000
+    return (distr_heat_areas, lor_index, end_energy, sheet,
+            norm_heat_profiles)
+
+
+def timed(function, *args, repeat=3):
+    """Mean duration and the result of a function."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def compare(name, loop, array, equal):
+    print("{0:<36} loop {1:7.3f} s, array {2:7.3f} s, "
+          "speed-up {3:5.1f}, equal: {4}".format(
+              name, loop, array, loop / array, equal))
+
+
+def benchmark_heat_profiles(data):
+    (distr_heat_areas, lor_index, end_energy, sheet,
+     norm_heat_profiles) = create_sources(data)
+
+    # Replace the sources with the synthetic tables.
+    heat.get_building_data = lambda: (data, distr_heat_areas, lor_index)
+    berlin_hp.balance.get_heat_demand = lambda year, state: end_energy.copy()
+    berlin_hp.balance.get_bmwi_sheet_7 = lambda s: sheet.copy()
+    heat.create_standardised_heat_load_profile = (
+        lambda shlp, year: norm_heat_profiles.copy())
+
+    loop, (a, fuels_a) = timed(get_annual_heat_demand_loop, YEAR, data)
+    array, (b, fuels_b) = timed(heat.get_annual_heat_demand, YEAR, data)
+    columns = sorted(a.columns)
+    equal = (fuels_a == fuels_b and columns == sorted(b.columns) and
+             np.allclose(a[columns].values.astype(float), b[columns].values,
+                         equal_nan=True))
+    compare("get_annual_heat_demand", loop, array, equal)
+
+    for region in ['berlin', 10201]:
+        loop, a = timed(create_heat_profiles_loop, YEAR, region, data,
+                        distr_heat_areas)
+        array, b = timed(heat.create_heat_profiles, YEAR, region)
+        equal = (sorted(a.columns) == sorted(b.columns) and
+                 np.allclose(a[sorted(a.columns)].values,
+                             b[sorted(b.columns)].values))
+        compare("create_heat_profiles ({0})".format(region), loop, array,
+                equal)
+
+
+if __name__ == "__main__":
+    benchmark_heat_profiles(create_buildings(BUILDINGS))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Memory benchmark of the xml-parser of the electricity grid data.
+
+A synthetic SmeterEngine file with one district is created and parsed with
+read_net_xml. Apart from the resulting table the peak memory has to stay
+flat if the number of time steps in one element grows.
+
+The previous converter (read_net_xml_dom), which parses the whole file into
+a tree and grows a DataFrame row by row, is run on the same files and the
+results are compared. It takes minutes for a year of 15-minute values, so it
+is only run on the files up to `--baseline-rows` rows (default: 35000).
+
+Run: python benchmarks/read_net_xml_memory.py [--baseline-rows N]
+
+SPDX-FileCopyrightText: 2016-2019 Uwe Krien <krien@uni-bremen.de>
+
+SPDX-License-Identifier: MIT
+"""
+__copyright__ = "Uwe Krien <krien@uni-bremen.de>"
+__license__ = "MIT"
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+
+from berlin_hp.electricity import read_net_xml
+
+
+def read_net_xml_dom(filename):
+    """Parsing part of the previous convert_net_xml2df."""
+    tree = ElementTree.parse(filename)
+    elem = tree.getroot()
+    n = 0
+    attributes = ["usage", "generation", "feed", "key-acount-usage"]
+    df = pd.DataFrame(columns=attributes)
+    df_temp = pd.DataFrame(columns=attributes)
+    for distr_ele in elem.find("district"):
+        for f in list(distr_ele):
+            value_list = []
+            for atr in attributes:
+                value_list.append(float(f.find(atr).text))
+            df_temp.loc[f.attrib["value"], attributes] = value_list
+            if n % 100 == 0:
+                df = pd.concat([df, df_temp])
+                df_temp = pd.DataFrame(columns=attributes)
+            n += 1
+    return pd.concat([df, df_temp])
+
+
+def create_xml(filename, rows):
+    """Write one district with all time steps in one day element."""
+    with open(filename, "w") as f:
+        f.write('<smeterengine><district name="x"><day value="2014-01-01">')
+        for n in range(rows):
+            f.write(
+                '<value value="{0}"><usage>{1}.5</usage>'
+                "<generation>1.0</generation><feed>2.0</feed>"
+                "<key-acount-usage>3.0</key-acount-usage></value>".format(
+                    n, n
+                )
+            )
+        f.write("</day></district></smeterengine>")
+
+
+def measure(reader, filename):
+    tracemalloc.start()
+    start = time.perf_counter()
+    df = reader(filename)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return df, duration, peak / 2 ** 20
+
+
+def report(name, df, duration, peak):
+    size = df.memory_usage(deep=True).sum()
+    print(
+        "{0:<16} {1:>7} rows: {2:7.2f} s, peak {3:6.1f} MB, "
+        "result {4:6.1f} MB".format(
+            name, len(df), duration, peak, size / 2 ** 20
+        )
+    )
+
+
+if __name__ == "__main__":
+    baseline_rows = 35000
+    if "--baseline-rows" in sys.argv:
+        baseline_rows = int(sys.argv[sys.argv.index("--baseline-rows") + 1])
+    path = tempfile.mkdtemp()
+    for rows in [35000, 70000, 140000]:
+        fn = os.path.join(path, "grid_{0}.xml".format(rows))
+        create_xml(fn, rows)
+        new = measure(read_net_xml, fn)
+        report("read_net_xml", *new)
+        if rows <= baseline_rows:
+            old = measure(read_net_xml_dom, fn)
+            report("read_net_xml_dom", *old)
+            equal = list(old[0].index) == list(
+                new[0].index
+            ) and np.array_equal(old[0].values.astype(float), new[0].values)
+            print(
+                "{0:<16} speed-up {1:5.1f}, equal: {2}".format(
+                    "", old[1] / new[1], equal
+                )
+            )
+        os.remove(fn)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+"""Dependency tracked cache of derived files.
+
+Every derived file (artifact) is registered as a step with its builder, the
+steps it depends on, its static input files and its parameters. A key is
+calculated from the parameters, the hash of the input files and the hash of
+the files of the upstream steps and stored with these inputs next to the file
+('<filename>.key'). A step is rebuilt if its file or the file of an upstream
+step is missing or if one of its inputs has changed.
+
+SPDX-FileCopyrightText: 2016-2019 Uwe Krien <krien@uni-bremen.de>
+
+SPDX-License-Identifier: MIT
+"""
+__copyright__ = "Uwe Krien <krien@uni-bremen.de>"
+__license__ = "MIT"
+
+# Python libraries
+import hashlib
+import inspect
+import json
+import logging
+import os
+from collections import namedtuple
+
+# internal modules
+import berlin_hp.download as download
+
+
+Step = namedtuple(
+    "Step", ["name", "filename", "builder", "depends", "files", "params"]
+)
+
+STEPS = {}
+
+# Checksums of the input files and records of the artifacts (see get_record)
+CHECKSUMS = {}
+RECORDS = {}
+
+
+def register(
+    name, filename, builder, depends=None, files=None, params=None
+):
+    """Register a derived file.
+
+    All arguments except `name` and `depends` are functions, that are
+    called with the keyword arguments of the artifact (e.g. the region).
+
+    Parameters
+    ----------
+    name : str
+        Name of the step.
+    filename : callable
+        Returns the full filename of the artifact.
+    builder : callable
+        Creates the file.
+    depends : list or None
+        Upstream steps as name or as (name, kwargs) tuple.
+    files : callable or None
+        Returns a list of static input files.
+    params : callable or None
+        Returns a json serialisable dictionary with the parameters.
+    """
+    depends = [(d, {}) if isinstance(d, str) else d for d in depends or []]
+    STEPS[name] = Step(
+        name,
+        filename,
+        builder,
+        depends,
+        files or (lambda **kwargs: []),
+        params or (lambda **kwargs: {}),
+    )
+
+
+def get_step(name):
+    """Registered step of the given name."""
+    if name not in STEPS:
+        # The steps of the ALKIS/OEQ chain are registered on import.
+        import berlin_hp.my_open_e_quarter  # noqa: F401
+    return STEPS[name]
+
+
+def normalize(name, kwargs):
+    """Complete the keyword arguments with the defaults of the step.
+
+    get('a') and get('a', bzr=None) have to be the same artifact, so the
+    arguments are bound to the signature of the filename function.
+    """
+    bound = inspect.signature(get_step(name).filename).bind(**kwargs)
+    bound.apply_defaults()
+    return dict(bound.arguments)
+
+
+def file_checksum(filename):
+    """Checksum of a file, calculated only once for each version of a file.
+
+    The version of a file is identified by its path, modification time and
+    size.
+    """
+    stat = os.stat(filename)
+    version = (filename, stat.st_mtime_ns, stat.st_size)
+    if version not in CHECKSUMS:
+        CHECKSUMS[version] = download.checksum(filename)
+    return CHECKSUMS[version]
+
+
+def file_version(filename):
+    """Modification time and size of a file or None if it is missing."""
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def output_files(filename):
+    """Files that make up the file of a step.
+
+    The attributes of a shapefile are stored in its dbf-file.
+    """
+    if filename.endswith(".shp"):
+        return [filename, filename[:-4] + ".dbf"]
+    return [filename]
+
+
+def output_checksum(filename):
+    """Checksum of the file of a step or None if a part of it is missing."""
+    files = output_files(filename)
+    if not all(os.path.isfile(f) for f in files):
+        return None
+    return "".join(file_checksum(f) for f in files)
+
+
+def dependency_id(name, kwargs):
+    """Identifier of an upstream step in the record of an artifact."""
+    return json.dumps(
+        [name, normalize(name, kwargs)], sort_keys=True, default=str
+    )
+
+
+def key_filename(name, **kwargs):
+    return get_step(name).filename(**normalize(name, kwargs)) + ".key"
+
+
+def read_record(name, **kwargs):
+    """Record stored next to an artifact or None if there is no record.
+
+    Key files of older versions contain only the key.
+    """
+    key_file = key_filename(name, **kwargs)
+    if not os.path.isfile(key_file):
+        return None
+    with open(key_file) as f:
+        content = f.read().strip()
+    try:
+        return json.loads(content)
+    except ValueError:
+        return {"key": content}
+
+
+def write_record(name, record, **kwargs):
+    key_file = key_filename(name, **kwargs)
+    with open(key_file + ".part", "w") as f:
+        json.dump(record, f, sort_keys=True)
+    os.replace(key_file + ".part", key_file)
+
+
+def get_record(name, **kwargs):
+    """Current inputs of an artifact.
+
+    Upstream steps and static input files are represented by the checksum
+    of their file, so a rebuilt upstream file with new content changes the
+    key. Missing inputs are None. The record is calculated only once for
+    each version of the input files.
+    """
+    kwargs = normalize(name, kwargs)
+    step = get_step(name)
+    files = step.files(**kwargs)
+    upstream = {
+        dependency_id(dep, dep_kwargs): get_step(dep).filename(
+            **normalize(dep, dep_kwargs)
+        )
+        for dep, dep_kwargs in step.depends
+    }
+    version = (
+        dependency_id(name, kwargs),
+        json.dumps(step.params(**kwargs), sort_keys=True, default=str),
+        tuple((f, file_version(f)) for f in files),
+        tuple(
+            (f, file_version(f))
+            for u in upstream.values()
+            for f in output_files(u)
+        ),
+    )
+    if version not in RECORDS:
+        record = {
+            "params": hashlib.md5(
+                "".join(version[:2]).encode()
+            ).hexdigest(),
+            "upstream": {
+                dep_id: output_checksum(f) for dep_id, f in upstream.items()
+            },
+            "files": {
+                f: file_checksum(f) if os.path.isfile(f) else None
+                for f in files
+            },
+        }
+        record["key"] = hashlib.md5(
+            json.dumps(record, sort_keys=True).encode()
+        ).hexdigest()
+        RECORDS[version] = record
+    return RECORDS[version]
+
+
+def get_key(name, **kwargs):
+    """Key of an artifact calculated from all its inputs."""
+    return get_record(name, **kwargs)["key"]
+
+
+def is_stale(name, dry_run=False, **kwargs):
+    """Check if an artifact has to be (re)built.
+
+    An artifact is stale if its file or the file of an upstream step is
+    missing, if an upstream step is stale or if the parameters, the static
+    input files or the content of the upstream files have changed. Static
+    input files that are missing now or were missing when the file was
+    built are not checked. Existing files without a key file (created
+    without this cache or by an older version of it) are adopted with the
+    current inputs, unless `dry_run` is True.
+    """
+    kwargs = normalize(name, kwargs)
+    step = get_step(name)
+    filename = step.filename(**kwargs)
+    if not os.path.isfile(filename):
+        return True
+    stored = read_record(name, **kwargs)
+    if stored is None or "upstream" not in stored:
+        if not dry_run:
+            logging.info("Adopt existing file {0}.".format(filename))
+            for dep, dep_kwargs in step.depends:
+                is_stale(dep, **dep_kwargs)
+            write_record(name, get_record(name, **kwargs), **kwargs)
+        return False
+    current = get_record(name, **kwargs)
+    if stored["params"] != current["params"]:
+        return True
+    for f, md5 in current["files"].items():
+        if None not in (md5, stored["files"].get(f)):
+            if md5 != stored["files"][f]:
+                return True
+    for dep, dep_kwargs in step.depends:
+        if is_stale(dep, dry_run=dry_run, **dep_kwargs):
+            return True
+        dep_id = dependency_id(dep, dep_kwargs)
+        if stored["upstream"].get(dep_id) != current["upstream"][dep_id]:
+            return True
+    return False
+
+
+def is_changed(name, **kwargs):
+    """Check if the inputs of an artifact differ from its stored record.
+
+    Returns False if there is no record (e.g. the first build was
+    interrupted), so builders can resume a partial build in this case.
+    """
+    stored = read_record(name, **kwargs)
+    if stored is None or "upstream" not in stored:
+        return False
+    return stored["key"] != get_key(name, **kwargs)
+
+
+def plan(name, **kwargs):
+    """List the steps that would run to update an artifact (dry-run).
+
+    Returns
+    -------
+    list : (name, kwargs) tuples in the order of execution.
+    """
+    kwargs = normalize(name, kwargs)
+    if not is_stale(name, dry_run=True, **kwargs):
+        return []
+    steps = []
+    for dep, dep_kwargs in get_step(name).depends:
+        steps.extend(s for s in plan(dep, **dep_kwargs) if s not in steps)
+    steps.append((name, kwargs))
+    return steps
+
+
+def get(name, **kwargs):
+    """Update an artifact and its upstream steps if it is stale.
+
+    Upstream steps are only updated if the artifact has to be rebuilt.
+
+    Returns
+    -------
+    str : Full filename of the artifact.
+    """
+    kwargs = normalize(name, kwargs)
+    step = get_step(name)
+    filename = step.filename(**kwargs)
+    if is_stale(name, **kwargs):
+        for dep, dep_kwargs in step.depends:
+            get(dep, **dep_kwargs)
+        logging.info("Build {0} {1}.".format(name, kwargs or ""))
+        step.builder(**kwargs)
+        write_record(name, get_record(name, **kwargs), **kwargs)
+    return filename
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Cached tables of the energy balance and the BMWi energy data.
+
+The tables are static but slow to read from the spreadsheets, so they are
+stored as hdf5 files in [paths] balance and kept in memory. Delete the files
+and use clear_cache() to read the sources again.
+
+SPDX-FileCopyrightText: 2016-2019 Uwe Krien <krien@uni-bremen.de>
+
+SPDX-License-Identifier: MIT
+"""
+__copyright__ = "Uwe Krien <krien@uni-bremen.de>"
+__license__ = "MIT"
+
+# Python libraries
+import logging
+import os
+import tempfile
+
+# External libraries
+import numpy as np
+import pandas as pd
+
+# internal modules
+from reegis import config as cfg
+from reegis import demand_heat
+from reegis import energy_balance
+import reegis.bmwi
+
+
+# Memory cache of the tables
+TABLES = {}
+
+
+def get_table(name, builder, **keys):
+    """Get a table from the memory cache, the file cache or the builder.
+
+    Parameters
+    ----------
+    name : str
+        Name of the table.
+    builder : callable
+        Creates the table from the keys.
+    keys :
+        Keys of the table (e.g. year, state, sheet).
+
+    Returns
+    -------
+    pandas.DataFrame : A copy of the cached table.
+    """
+    key = '_'.join([name] + ['{0}'.format(keys[k]) for k in sorted(keys)])
+    if key not in TABLES:
+        filename = os.path.join(cfg.get('paths', 'balance'),
+                                '{0}.hdf'.format(key))
+        if os.path.isfile(filename):
+            TABLES[key] = pd.read_hdf(filename, 'table')
+        else:
+            logging.info("Read {0} from source.".format(key))
+            table = builder(**keys)
+            numeric = table.select_dtypes(include=[np.number]).columns
+            table[numeric] = table[numeric].astype(np.float64)
+            os.makedirs(cfg.get('paths', 'balance'), exist_ok=True)
+            # A unique temporary file, so that concurrent processes do not
+            # write to the same file.
+            fd, part_file = tempfile.mkstemp(
+                suffix='.part', dir=os.path.dirname(filename))
+            os.close(fd)
+            try:
+                table.to_hdf(part_file, 'table', mode='w')
+                os.replace(part_file, filename)
+            finally:
+                if os.path.isfile(part_file):
+                    os.remove(part_file)
+            TABLES[key] = table
+    return TABLES[key].copy()
+
+
+def clear_cache():
+    """Remove all tables from the memory cache."""
+    TABLES.clear()
+
+
+def get_heat_demand(year, state='BE'):
+    """End energy for heating (TJ) by sector and fuel (reegis.demand_heat).
+    """
+    return get_table(
+        'heat_demand',
+        lambda year, state: demand_heat.heat_demand(year).loc[state],
+        year=year, state=state)
+
+
+def get_usage_balance(year, state='BE'):
+    """Grouped usage balance (TJ) of the energy balance (reegis)."""
+    return get_table(
+        'usage_balance',
+        lambda year, state: energy_balance.get_usage_balance(
+            year=year, grouped=True).loc[state],
+        year=year, state=state)
+
+
+def get_bmwi_sheet_7(sheet):
+    """Sheet 7 ('a' or 'b') of the BMWi energy data (reegis.bmwi)."""
+    return get_table(
+        'bmwi_sheet_7',
+        lambda sheet: reegis.bmwi.read_bmwi_sheet_7(sheet),
+        sheet=sheet)
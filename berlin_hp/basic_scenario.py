@@ -1,7 +1,11 @@
 import pandas as pd
 import datetime
 import logging
+import multiprocessing
 import os
+from collections import OrderedDict
+from concurrent import futures
+from functools import partial
 
 from reegis import config as cfg
 import reegis.commodity_sources
@@ -14,41 +18,46 @@ from reegis import geometries
 import oemof.tools.logger as logger
 
 import berlin_hp.heat as heat
+import berlin_hp.balance
 import berlin_hp.electricity
 import berlin_hp.scenario_tools as scenario_tools
 
 
-def create_scenario(regions, year, name):
-    table_collection = {}
-
-    logging.info('BASIC SCENARIO - FEED-IN TIME SERIES')
-    table_collection['time_series'] = scenario_feedin(regions, year, name)
-
-    logging.info('BASIC SCENARIO - HEAT DEMAND TIME SERIES')
-    table_collection['time_series'] = scenario_heat_profiles(
-        year, table_collection['time_series'])
-
-    logging.info('BASIC SCENARIO - DEMAND')
-    table_collection['time_series'] = scenario_elec_demand(
-        year, table_collection['time_series'])
-
-    # logging.info('BASIC SCENARIO - STORAGES')
-    # table_collection['storages'] = scenario_storages()
-    #
-    logging.info('BASIC SCENARIO - POWER PLANTS')
-    table_collection['powerplants'] = scenario_powerplants(
-        year, table_collection['time_series'])
-
-    logging.info('BASIC SCENARIO - DECENTRALISED HEAT')
-    table_collection['decentralised_heating'] = decentralised_heating()
-
-    logging.info('BASIC SCENARIO - SOURCES')
-    table_collection['commodity_sources'] = commodity_sources(year)
-
-    logging.info('BASIC SCENARIO - VOLATILE SOURCES')
-    table_collection['volatile_source'] = scenario_volatile_sources(year)
-
-    return table_collection
+def create_scenario(regions, year, name, max_workers=None, processes=None):
+    """Create the tables of the basic scenario of a year.
+
+    The tables are independent of each other except the power plants, which
+    need the district heating demand, so they are created in parallel
+    threads (see scenario_tools.build_tables). The builders that use hdf5
+    files (feed-in, heat and electricity demand, volatile sources) run one
+    after another unless they run in `processes` processes.
+    """
+    builder = scenario_tools.TableBuilder
+    builders = OrderedDict([
+        ('feedin', builder(
+            'time_series', partial(scenario_feedin, regions, year, name), [],
+            hdf=True)),
+        ('heat_profiles', builder(
+            'time_series', partial(scenario_heat_profiles, year, None), [],
+            hdf=True)),
+        ('elec_demand', builder(
+            'time_series', partial(scenario_elec_demand, year, None), [],
+            hdf=True)),
+        # ('storages', builder('storages', scenario_storages, [])),
+        ('powerplants', builder(
+            'powerplants', partial(scenario_powerplants, year),
+            ['heat_profiles'])),
+        ('decentralised_heating', builder(
+            'decentralised_heating', decentralised_heating, [])),
+        ('commodity_sources', builder(
+            'commodity_sources', partial(commodity_sources, year), [])),
+        ('volatile_source', builder(
+            'volatile_source', partial(scenario_volatile_sources, year), [],
+            hdf=True)),
+    ])
+    logging.info('BASIC SCENARIO - {0}'.format(year))
+    return scenario_tools.build_tables(
+        builders, max_workers=max_workers, processes=processes)
 
 
 def time_logger(txt, ref):
@@ -174,7 +183,8 @@ def scenario_heat_profiles(year, ts, basic_scenario=True):
             df[(dh_name, col)] = df[(dc_name, col)]
             del df[(dc_name, col)]
     df.reset_index(drop=True, inplace=True)
-    df = pd.concat([ts, df], axis=1)
+    if ts is not None:
+        df = pd.concat([ts, df], axis=1)
     if basic_scenario is True:
         df['decentralised_demand', 'elec'] = 0
     return df
@@ -182,12 +192,16 @@ def scenario_heat_profiles(year, ts, basic_scenario=True):
 
 def scenario_elec_demand(year, time_series):
     elec_demand = berlin_hp.electricity.get_electricity_demand(year)
+    if time_series is None:
+        time_series = pd.DataFrame(
+            columns=pd.MultiIndex(levels=[[], []], codes=[[], []]))
     time_series['electricity', 'demand'] = elec_demand.usage.values * 1000
     return time_series
 
 
-def create_basic_scenario(regions, year, name):
-    table_collection = create_scenario(regions, year, name)
+def create_basic_scenario(regions, year, name, max_workers=None):
+    table_collection = create_scenario(
+        regions, year, name, max_workers=max_workers)
     name = '{0}_{1}_{2}'.format('berlin_hp', year, 'single')
     sce = scenario_tools.Scenario(table_collection=table_collection,
                                   name=name, year=year)
@@ -196,6 +210,51 @@ def create_basic_scenario(regions, year, name):
     sce.to_csv(os.path.join(path, '{0}_csv'.format(name)))
 
 
+def create_basic_scenarios(regions, years, name, max_workers=None):
+    """Create the basic scenarios of several years in a process pool.
+
+    Every year is created in a process of its own, which builds the tables
+    in threads (see create_scenario). The number of processes times the
+    number of threads of each process does not exceed `max_workers`.
+
+    If the processes are started with fork (default on Linux), the building
+    data (building table with heat factors and district heating areas) and
+    the tables of the energy balance are loaded before, so the processes
+    share them instead of reading them once per year. With spawn (default on
+    macOS and Windows) every process loads them on its own.
+
+    Parameters
+    ----------
+    regions : geopandas.GeoDataFrame
+    years : list
+    name : str
+    max_workers : int or None
+        Maximal number of parallel workers (processes x threads). Defaults
+        to the number of processors.
+    """
+    start = datetime.datetime.now()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    processes = max(min(len(years), max_workers), 1)
+    threads = max(max_workers // processes, 1)
+    if multiprocessing.get_start_method() == 'fork':
+        heat.get_building_data()
+        for sheet in ['a', 'b']:
+            berlin_hp.balance.get_bmwi_sheet_7(sheet)
+        for y in years:
+            berlin_hp.balance.get_heat_demand(y, 'BE')
+            berlin_hp.balance.get_usage_balance(y, 'BE')
+    with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        jobs = {executor.submit(
+            create_basic_scenario, regions, y, name, threads): y
+            for y in years}
+        for job in futures.as_completed(jobs):
+            job.result()
+            mesg = "Basic scenario for {0} created: {1}"
+            logging.info(mesg.format(jobs[job],
+                                     datetime.datetime.now() - start))
+
+
 if __name__ == "__main__":
     logger.define_logging()
     start = datetime.datetime.now()
@@ -203,8 +262,5 @@ if __name__ == "__main__":
         cfg.get('paths', 'geo_berlin'), 'berlin.csv')
     reg = geometries.load(fullname=berlin_district_fn, index_col='gid')
     n = 'BE'
-    for y in [2014, 2013, 2012]:
-        create_basic_scenario(reg, y, n)
-        mesg = "Basic scenario for {0} created: {1}"
-        logging.info(mesg.format(y, datetime.datetime.now() - start))
+    create_basic_scenarios(reg, [2014, 2013, 2012], n)
     logging.info("Done: {0}".format(datetime.datetime.now() - start))
@@ -7,19 +7,29 @@ Created on Tue Mar 15 16:33:38 2016
 
 import requests
 import os
+import re
+import time
+import hashlib
+import json
+import threading
+from urllib3.util.retry import Retry
+from concurrent import futures
+from xml.etree import ElementTree
 from owslib.wfs import WebFeatureService
 from reegis import config as cfg
-import subprocess as sub
+import pandas as pd
 import geopandas as gpd
 import logging
-from fiona import crs
 import oemof.tools.logger as logger
-from shutil import copyfile
+
+
+# Coordinate reference system of the WFS requests
+SRS_NAME = 'EPSG:25833'
 
 
 def feature2gml(bbox, file, table, wfs11):
     response = wfs11.getfeature(typename='fis:' + table,
-                                bbox=bbox, srsname='EPSG:25833')
+                                bbox=bbox, srsname=SRS_NAME)
     out = open(file, 'wb')
     try:
         out.write(bytes(response.read(), 'UTF-8'))
@@ -28,13 +38,219 @@ def feature2gml(bbox, file, table, wfs11):
     out.close()
 
 
-def dump_from_wfs(table, server, version='1.1.0'):
+def count_gml_features(file):
+    """Number of features in a gml-file returned by a WFS."""
+    n = 0
+    depth = 0
+    members = False
+    for event, elem in ElementTree.iterparse(file, events=('start', 'end')):
+        if event == 'start':
+            if depth == 0:
+                for attr in ('numberOfFeatures', 'numberReturned'):
+                    if elem.attrib.get(attr, '').isdigit():
+                        return int(elem.attrib[attr])
+            elif depth == 1:
+                members = elem.tag.endswith('featureMembers')
+                if elem.tag.endswith('featureMember'):
+                    n += 1
+            elif depth == 2 and members:
+                n += 1
+            depth += 1
+        else:
+            depth -= 1
+            if depth < 2:
+                elem.clear()
+    return n
+
+
+def gml_srs_name(file):
+    """Coordinate reference system (srsName) of the first geometry of a
+    gml-file or None if there is no srsName.
+    """
+    for event, elem in ElementTree.iterparse(file):
+        srs = elem.attrib.get('srsName')
+        if srs is not None:
+            # e.g. 'urn:ogc:def:crs:EPSG::25833' or '...epsg.xml#25833'
+            code = re.split('[:#]', srs)[-1]
+            if 'epsg' in srs.lower() and code.isdigit():
+                return 'EPSG:' + code
+            return srs
+        elem.clear()
+    return None
+
+
+def split_tile(bbox):
+    """Split a bounding box into four quarters."""
+    x1, y1, x2, y2 = bbox
+    xm = (x1 + x2) / 2
+    ym = (y1 + y2) / 2
+    return [(x1, y1, xm, ym), (xm, y1, x2, ym),
+            (x1, ym, xm, y2), (xm, ym, x2, y2)]
+
+
+def download_tile(fetch, bbox, fullpath, retries=3, backoff=2):
+    """Download one tile to a temporary file and rename it if complete.
+
+    Failed requests are repeated `retries` times with an exponential
+    backoff starting with `backoff` seconds.
+    """
+    tmp_file = fullpath + '.part'
+    for attempt in range(retries + 1):
+        try:
+            fetch(bbox, tmp_file)
+            os.replace(tmp_file, fullpath)
+            return fullpath
+        except Exception as e:
+            if attempt == retries:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            wait = backoff * 2 ** attempt
+            logging.warning("Download of {0} failed ({1}). Retry in {2}s."
+                            .format(os.path.basename(fullpath), e, wait))
+            time.sleep(wait)
+
+
+def download_tiles(tiles, path, table, fetch, max_workers=4, retries=3,
+                   backoff=2, max_features=None, max_split_depth=3):
+    """Download tiles concurrently and split tiles hitting the feature limit.
+
+    Existing gml-files are skipped, so an interrupted download can be
+    resumed. Split tiles are marked with a '.split' file and their quarters
+    are named with an additional suffix.
+
+    Parameters
+    ----------
+    tiles : dict
+        Bounding box of each tile with the name suffix of the tile as key.
+    path : str
+        Directory of the gml-files.
+    table : str
+        Name of the table, used as prefix for the gml-files.
+    fetch : callable
+        Function with the parameters bbox and filename, that writes the
+        features of the bounding box to the file.
+    max_workers : int
+        Maximal number of parallel requests.
+    retries : int
+        Number of retries for each tile.
+    backoff : float
+        Initial waiting time in seconds before a retry.
+    max_features : int or None
+        Feature limit of the server. Tiles with this number of features are
+        split into quarters. If None tiles are never split.
+    max_split_depth : int
+        Maximal number of splits of a tile. A warning is logged for tiles
+        that still hit the feature limit after this number of splits.
+
+    Returns
+    -------
+    list : Filenames of all downloaded tiles.
+    """
+    pending = [(name, bbox, 0) for name, bbox in tiles.items()]
+    files = []
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            while pending:
+                name, bbox, depth = pending.pop()
+                fullpath = os.path.join(
+                    path, "{0}_{1}.gml".format(table, name))
+                if os.path.isfile(fullpath[:-4] + '.split'):
+                    pending.extend(
+                        ("{0}_{1}".format(name, n), sub_box, depth + 1)
+                        for n, sub_box in enumerate(split_tile(bbox)))
+                elif os.path.isfile(fullpath):
+                    files.append(fullpath)
+                else:
+                    logging.info("Processing tile {0}".format(name))
+                    future = executor.submit(
+                        download_tile, fetch, bbox, fullpath, retries,
+                        backoff)
+                    running[future] = (name, bbox, depth)
+
+            done, _ = futures.wait(
+                running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                name, bbox, depth = running.pop(future)
+                fullpath = future.result()
+                if (max_features is not None and
+                        count_gml_features(fullpath) >= max_features):
+                    if depth < max_split_depth:
+                        logging.info("Tile {0} hit the feature limit. Split."
+                                     .format(name))
+                        open(fullpath[:-4] + '.split', 'w').close()
+                        os.remove(fullpath)
+                        pending.append((name, bbox, depth))
+                        continue
+                    logging.warning(
+                        "Tile {0} hit the feature limit of {1} at the "
+                        "maximal split depth of {2}. The features of the "
+                        "tile may be incomplete. Increase max_split_depth "
+                        "and remove {3} to download it again.".format(
+                            name, max_features, max_split_depth, fullpath))
+                files.append(fullpath)
+    return sorted(files)
+
+
+def capabilities_max_features(xml):
+    """Default number of features of a request stated in the capabilities
+    of a WFS (DefaultMaxFeatures or CountDefault) or None if there is none.
+    """
+    for elem in ElementTree.fromstring(xml).iter():
+        if (elem.tag.endswith('Constraint') and
+                elem.attrib.get('name') in ('DefaultMaxFeatures',
+                                            'CountDefault')):
+            for value in elem.iter():
+                if (value.tag.endswith(('DefaultValue', 'Value')) and
+                        (value.text or '').strip().isdigit()):
+                    return int(value.text)
+    return None
+
+
+def get_max_features(wfs=None):
+    """Feature limit of the requests to a WFS.
+
+    The limit is taken from [fis_broker] max_features. If it is 'auto', the
+    limit is read from the capabilities of the WFS. If the server does not
+    state a limit, a warning is logged and tiles are not split. Use None in
+    the config file to switch off the splitting of the tiles explicitly.
+    """
+    max_features = cfg.get('fis_broker', 'max_features')
+    if max_features != 'auto':
+        return max_features
+    if wfs is not None:
+        try:
+            max_features = capabilities_max_features(
+                wfs.getcapabilities().read())
+        except Exception as e:
+            logging.warning("Reading the capabilities failed ({0}).".format(
+                e))
+            max_features = None
+    else:
+        max_features = None
+    if max_features is None:
+        logging.warning(
+            "The feature limit of the server is unknown, so tiles that hit "
+            "the limit are not detected. Set [fis_broker] max_features.")
+    else:
+        logging.info("Feature limit of the server: {0}".format(max_features))
+    return max_features
+
+
+def dump_from_wfs(table, server, version='1.1.0', fetch=None):
+
+    wfs11 = None
+    if fetch is None:
+        wfs11 = WebFeatureService(url=server + table, version=version,
+                                  timeout=300)
 
-    wfs11 = WebFeatureService(url=server + table, version=version, timeout=300)
+        logging.info("Download {0} from {1}".format(table, server))
+        logging.info(wfs11.identification.title)
+        logging.info(list(wfs11.contents))
 
-    logging.info("Download {0} from {1}".format(table, server))
-    logging.info(wfs11.identification.title)
-    logging.info(list(wfs11.contents))
+        def fetch(bbox, file):
+            feature2gml(bbox, file, table, wfs11)
 
     x_min = 369097
     y_min = 5799298
@@ -54,107 +270,103 @@ def dump_from_wfs(table, server, version='1.1.0'):
     if not os.path.isdir(path):
         os.mkdir(path)
 
+    tiles = {}
     for x_tile in range(number_of_tiles_x):
         for y_tile in range(number_of_tiles_y):
             my_box = (x_min + (x_tile * steps_x),
                       y_max - (y_tile * steps_y),
                       x_min + ((x_tile + 1) * steps_x),
                       y_max - ((y_tile + 1) * steps_y))
-            filename = "{0}_{1}_{2}.gml".format(table, x_tile, y_tile)
-            fullpath = os.path.join(path, filename)
-            if not os.path.isfile(fullpath):
-                logging.info("Processing tile {0}-{1}".format(x_tile, y_tile))
-                feature2gml(my_box, fullpath, table, wfs11)
+            tiles["{0}_{1}".format(x_tile, y_tile)] = my_box
+
+    download_tiles(
+        tiles, path, table, fetch,
+        max_workers=cfg.get('fis_broker', 'download_workers'),
+        retries=cfg.get('fis_broker', 'download_retries'),
+        backoff=cfg.get('fis_broker', 'download_backoff'),
+        max_features=get_max_features(wfs11),
+        max_split_depth=cfg.get('fis_broker', 'max_split_depth'))
     logging.info("Download completed.")
 
 
-def convert_gml2shp(table):
-    logging.info("Convert gml-files to shp-files for {0}".format(table))
-    basic_call = 'ogr2ogr -f "ESRI Shapefile" {0} {1}'
+def gml2geodataframe(table, id_col='gml_id', crs='EPSG:4326'):
+    """Read all gml-tiles of a table into one GeoDataFrame.
+
+    Features that occur in more than one tile are dropped on the fly using
+    the id column. The merged table is reprojected in one step. If the
+    gml-files do not define the crs of the geometries, the srsName of the
+    server answer or of the request (SRS_NAME) is used.
+
+    Parameters
+    ----------
+    table : str
+        Name of the table (directory of the gml-files).
+    id_col : str
+        Column with the unique id of each feature.
+    crs : str
+        Coordinate reference system of the resulting table.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+    """
+    logging.info("Read gml-files of {0}".format(table))
     src_path = os.path.join(cfg.get('paths', 'fis_broker'), table)
-    trg_path = os.path.join(src_path, 'shp')
-    os.makedirs(trg_path, exist_ok=True)
+    parts = []
+    ids = set()
+    src_crs = None
     for f in sorted(os.listdir(src_path)):
-        if '.gml' in f:
-            logging.debug("Convert {0} to shp".format(f))
-            src_file = os.path.join(src_path, f)
-            trg_file = os.path.join(trg_path, f[:-4] + '.shp')
-            ogr_call = basic_call.format(trg_file, src_file)
-            sub.Popen(
-                ogr_call, stderr=open(os.devnull, 'w'), shell=True).wait()
-    logging.info("Shp-files created.")
-
-
-def merge_shapefiles(path, table):
-    logging.info("Merge shp-files into {0}".format(table + '.shp'))
-    mergefile = os.path.join(path, 'merge.shp')
-    fileset = '{0} {1}'.format(mergefile, '{0}')
-    basic_call = (
-        'ogr2ogr -f "ESRI Shapefile" -t_srs EPSG:4326 -update -append'
-        ' {0} -nln merge')
-    basic_call = basic_call.format(fileset)
-    n = 0
-    for f in sorted(os.listdir(path)):
-        if '.shp' in f and 'merge' not in f:
-            f = os.path.join(path, f)
-            if os.path.isfile(f[:-4] + '.prj'):
-                logging.info("Merge {0}".format(f))
-                cmd = basic_call.format(f)
-                sub.Popen(cmd, stdout=open(os.devnull, 'w'), shell=True).wait()
-            f = f[:-4]
-            for s in ['.shx', '.shp', '.prj', '.dbf']:
-                if os.path.isfile(f + s):
-                    os.remove(f + s)
-            n += 1
-    # rename
-    newfile = os.path.join(path, table)
-    for s in ['.shx', '.shp', '.prj', '.dbf']:
-        if os.path.isfile(mergefile[:-4] + s):
-            copyfile(mergefile[:-4] + s, newfile + s)
-            os.rename(mergefile[:-4] + s, newfile + '_orig' + s)
-    logging.info("Merge completed.")
-
-
-def remove_duplicates(shp_file, id_col):
-    logging.info("Removing duplicates in {0}".format(shp_file))
-    geo_table = gpd.read_file(shp_file)
-    geo_table = geo_table.drop_duplicates(id_col)
-    geo_table.crs = crs.from_epsg(4326)
-    prj_file = shp_file.replace(".shp", ".prj")
-    prj = [l.strip() for l in open(prj_file, 'r')]
-    if len(prj) > 0:
-        prj = prj[0]
-    geo_table.to_file(shp_file, crs_wkt=prj)
-    logging.info("Duplicates removed.")
-
-
-def shapefile_from_wfs(table, server, id_col='gml_id', keep_orig=False):
+        src_file = os.path.join(src_path, f)
+        if f.endswith('.gml') and count_gml_features(src_file) > 0:
+            logging.debug("Read {0}".format(f))
+            part = gpd.read_file(src_file)
+            if src_crs is None:
+                src_crs = part.crs or gml_srs_name(src_file) or SRS_NAME
+            part = part.loc[~part[id_col].isin(ids)].drop_duplicates(id_col)
+            ids.update(part[id_col])
+            parts.append(part)
+    if len(parts) == 0:
+        logging.warning("No features found in {0}.".format(src_path))
+        return gpd.GeoDataFrame(
+            columns=[id_col, 'geometry'], geometry='geometry', crs=crs)
+    geo_table = gpd.GeoDataFrame(
+        pd.concat(parts, ignore_index=True), crs=src_crs)
+    logging.info("{0} features read.".format(len(geo_table)))
+    return geo_table.to_crs(crs)
+
+
+def remove_tiles(table):
+    """Remove the downloaded gml-tiles of a table."""
+    path = os.path.join(cfg.get('paths', 'fis_broker'), table)
+    if os.path.isdir(path):
+        for f in os.listdir(path):
+            if f.endswith(('.gml', '.split', '.part')):
+                os.remove(os.path.join(path, f))
+
+
+def shapefile_from_wfs(table, server, id_col='gml_id', overwrite=False):
     path = os.path.join(cfg.get('paths', 'fis_broker'), table, 'shp')
     shp_file = os.path.join(path, table + '.shp')
-    if not os.path.isfile(shp_file):
+    if overwrite:
+        remove_tiles(table)
+    if overwrite or not os.path.isfile(shp_file):
         logging.info("Dump table {0} from {1}".format(table, server))
         dump_from_wfs(table=table, server=server)
-        convert_gml2shp(table)
-        merge_shapefiles(path, table)
-        remove_duplicates(shp_file, id_col)
+        os.makedirs(path, exist_ok=True)
+        gml2geodataframe(table, id_col).to_file(shp_file)
     else:
         logging.info("Table {0} exist. Download not necessary.".format(table))
-    if not keep_orig:
-        orig_file = os.path.join(path, table + '_orig')
-        for s in ['.shx', '.shp', '.prj', '.dbf']:
-                if os.path.isfile(orig_file + s):
-                    os.remove(orig_file + s)
     return shp_file
 
 
-def shapefile_from_fisbroker(table, senstadt_server=None):
+def shapefile_from_fisbroker(table, senstadt_server=None, overwrite=False):
     if senstadt_server == 'data':
         server = 'http://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/'
     elif senstadt_server == 'geometry':
         server = 'http://fbinter.stadt-berlin.de/fb/wfs/geometry/senstadt/'
     else:
         server = None
-    return shapefile_from_wfs(table=table, server=server)
+    return shapefile_from_wfs(table=table, server=server, overwrite=overwrite)
 
 
 def get_map_config():
@@ -165,23 +377,173 @@ def get_map_config():
     return maps
 
 
-def download_maps(single=None):
+def download_maps(single=None, overwrite=False):
     maps = get_map_config()
     filename = {}
 
     if single is None:
         for key in maps.keys():
-            filename[key] = shapefile_from_fisbroker(**maps[key])
+            filename[key] = shapefile_from_fisbroker(
+                **maps[key], overwrite=overwrite)
     else:
-        filename = shapefile_from_fisbroker(**maps[single])
+        filename = shapefile_from_fisbroker(
+            **maps[single], overwrite=overwrite)
+
+    return filename
+
 
+# Only one thread may create the shared session.
+SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """Shared HTTP session with a connection pool and retries.
+
+    The parameters are defined in the [http] section of the config file.
+    """
+    with SESSION_LOCK:
+        if not hasattr(get_session, 'session'):
+            # Retry all methods (also POST). The argument is named
+            # method_whitelist before urllib3 1.26.
+            retry_kwargs = {
+                'total': cfg.get('http', 'retries'),
+                'backoff_factor': cfg.get('http', 'backoff_factor'),
+                'status_forcelist': (429, 500, 502, 503, 504)}
+            try:
+                retry = Retry(allowed_methods=False, **retry_kwargs)
+            except TypeError:
+                retry = Retry(method_whitelist=False, **retry_kwargs)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=cfg.get('http', 'pool_size'),
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            get_session.session = session
+        return get_session.session
+
+
+def checksum(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def is_xml_file(filename):
+    """Check if a file is a well-formed xml-file and not an html page."""
+    try:
+        root = None
+        for event, elem in ElementTree.iterparse(filename, ('start', 'end')):
+            if root is None:
+                root = elem
+            elif event == 'end' and elem is not root:
+                elem.clear()
+    except ElementTree.ParseError:
+        return False
+    return root is not None and root.tag.lower() != 'html'
+
+
+def write_checksum(filename, md5):
+    with open(filename + '.md5.part', 'w') as f:
+        f.write(md5)
+    os.replace(filename + '.md5.part', filename + '.md5')
+
+
+def verify_checksum(filename):
+    """Check a downloaded file against the checksum stored on download.
+
+    Files without a checksum file (downloaded by older versions or
+    interrupted while the checksum was written) have to be well-formed
+    xml-files, so that cached error pages are not used as data. Their
+    checksum is stored, so the content is only checked once.
+    """
+    md5_file = filename + '.md5'
+    if not os.path.isfile(filename):
+        return False
+    if not os.path.isfile(md5_file):
+        if not is_xml_file(filename):
+            logging.warning("{0} is not a valid xml-file.".format(filename))
+            return False
+        write_checksum(filename, checksum(filename))
+        return True
+    with open(md5_file) as f:
+        return f.read().strip() == checksum(filename)
+
+
+def read_validators(filename):
+    """ETag and Last-Modified header of the last download of a file.
+
+    The headers are only returned if the file matches its checksum.
+    """
+    validators_file = filename + '.http'
+    if not os.path.isfile(validators_file) or not verify_checksum(filename):
+        return {}
+    with open(validators_file) as f:
+        return json.load(f)
+
+
+def download_file(url, filename, data=None, headers=None):
+    """Download a file using the shared session (POST if data is given).
+
+    If the file exists and matches its checksum, the request is conditional
+    (If-None-Match/If-Modified-Since) and the file is kept if the server
+    answers 'Not Modified'. Otherwise the response is streamed into a
+    temporary file, that is renamed if the download is complete. The
+    checksum and the ETag/Last-Modified headers are stored next to the file.
+    Error responses raise an HTTPError and are never written to the file.
+    """
+    headers = dict(headers or {})
+    validators = read_validators(filename)
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+
+    session = get_session()
+    timeout = cfg.get('http', 'timeout')
+    if data is None:
+        response = session.get(url, headers=headers, timeout=timeout,
+                               stream=True)
+    else:
+        response = session.post(url, data=data, headers=headers,
+                                timeout=timeout, stream=True)
+    with response:
+        if validators and response.status_code == 304:
+            logging.debug("{0} is not modified.".format(filename))
+            return filename
+        response.raise_for_status()
+        tmp_file = filename + '.part'
+        md5 = hashlib.md5()
+        with open(tmp_file, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                md5.update(chunk)
+                f.write(chunk)
+        validators = {k: response.headers[k] for k in ['ETag', 'Last-Modified']
+                      if k in response.headers}
+
+    # The checksum and headers of the old file must never be used for the
+    # new file, so they are removed before the file is replaced. The new
+    # ones are renamed from temporary files after the file is replaced. If
+    # the process stops in between, the file has no checksum and is checked
+    # by its content (see verify_checksum).
+    for ext in ['.md5', '.http']:
+        if os.path.isfile(filename + ext):
+            os.remove(filename + ext)
+    if validators:
+        with open(filename + '.http.part', 'w') as f:
+            json.dump(validators, f)
+    os.replace(tmp_file, filename)
+    write_checksum(filename, md5.hexdigest())
+    if validators:
+        os.replace(filename + '.http.part', filename + '.http')
     return filename
 
 
 def get_xml_from_server(url, xml, filename):
     headers = {'Content-Type': 'application/xml'}
-    response = requests.post(url, data=xml, headers=headers)
-    open(filename, 'wb').write(response.content)
+    download_file(url, filename, data=xml, headers=headers)
 
 
 def get_berlin_net_data(year, district=None):
@@ -232,6 +594,28 @@ def get_berlin_net_data(year, district=None):
     return filename
 
 
+def get_berlin_net_data_batch(queries, max_workers=4):
+    """Fetch the electricity grid data of several districts and years.
+
+    The requests are sent concurrently using the shared session.
+
+    Parameters
+    ----------
+    queries : list
+        List of (year, district) tuples. See get_berlin_net_data.
+    max_workers : int
+        Maximal number of parallel requests.
+
+    Returns
+    -------
+    list : Filenames in the order of the queries.
+    """
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        filenames = executor.map(
+            lambda q: get_berlin_net_data(q[0], q[1]), queries)
+        return list(filenames)
+
+
 if __name__ == "__main__":
     logger.define_logging(file_level=logging.INFO)
     # print(get_berlin_net_data(2014, district='Treptow-Koepenick'))
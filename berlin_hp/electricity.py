@@ -10,10 +10,12 @@ __copyright__ = "Uwe Krien <krien@uni-bremen.de>"
 __license__ = "MIT"
 
 
+import numpy as np
 import pandas as pd
 import os
 import logging
 import datetime
+from concurrent import futures
 
 from xml.etree import ElementTree
 
@@ -24,40 +26,124 @@ from reegis import config as cfg
 import berlin_hp.download
 
 
-def fill_data_gaps(df):
+def fill_data_gaps(df, report=False):
+    """Fill the gaps (nan or 0) of the grid data.
+
+    The gaps are filled with the values of the previous week first. The
+    remaining gaps are interpolated and gaps at the beginning are filled
+    backwards.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Grid data with the time stamps as strings in the index.
+    report : bool
+        If True a table with the number of values filled by each step and
+        the longest gap of each column is returned as well.
+
+    Returns
+    -------
+    pandas.DataFrame or tuple
+    """
     logging.info("Fill the gaps and resample to hourly values.")
-    df.index = pd.DatetimeIndex(df.reset_index()["index"].str.slice(0, 19))
-    df = df.apply(pd.to_numeric)
-    df = df.replace(0, float("nan"))
-    for col in df.columns:
-        df[col] = df[col].fillna(df[col].shift(7 * 4 * 24))
-        df[col] = df[col].interpolate()
-        df[col] = df[col].fillna(method="bfill")
-    return df
+    df.index = pd.to_datetime(
+        pd.Index(df.index).str.slice(0, 19), format="%Y-%m-%d %H:%M:%S"
+    )
+    df = df.astype(float)
+    df = df.mask(df == 0)
+    missing = df.isnull()
+    df = df.fillna(df.shift(7 * 4 * 24))
+    after_shift = df.isnull()
+    df = df.interpolate()
+    after_interpolation = df.isnull()
+    df = df.bfill()
 
+    if not report:
+        return df
 
-def convert_net_xml2df(year, filename, hourly=True):
-    tree = ElementTree.parse(filename)
-    elem = tree.getroot()
-    logging.info("Convert xml-file to csv-file for {0}".format(year))
+    # Length of the gap up to each time step (reset at each valid value).
+    cum_missing = missing.values.cumsum(axis=0)
+    gap_length = cum_missing - np.maximum.accumulate(
+        np.where(missing.values, 0, cum_missing), axis=0
+    )
+    longest = gap_length.max(axis=0)
+    # Columns without gaps start at 0, so the index is always valid.
+    start = np.where(
+        longest > 0, gap_length.argmax(axis=0) - longest + 1, 0
+    )
+    gap_report = pd.DataFrame(
+        {
+            "missing": missing.sum(),
+            "week_shift": missing.sum() - after_shift.sum(),
+            "interpolated": after_shift.sum() - after_interpolation.sum(),
+            "backfilled": after_interpolation.sum() - df.isnull().sum(),
+            "remaining": df.isnull().sum(),
+            "longest_gap": longest,
+            "longest_gap_start": df.index[start].where(longest > 0),
+        }
+    )
+    return df, gap_report
+
+
+def read_net_xml(filename, attributes=None):
+    """Read the values of a SmeterEngine xml-file into a DataFrame.
+
+    The file is parsed as a stream and the values are collected in a
+    preallocated array, so the memory usage does not grow with the parsed
+    elements.
+
+    Parameters
+    ----------
+    filename : str
+        Full name of the xml-file.
+    attributes : list or None
+        Names of the values of each time step.
+
+    Returns
+    -------
+    pandas.DataFrame : Values with the raw time stamps as index.
+    """
+    if attributes is None:
+        attributes = ["usage", "generation", "feed", "key-acount-usage"]
+
+    size = 4 * 24 * 366
+    values = np.empty((size, len(attributes)))
+    index = np.empty(size, dtype=object)
     n = 0
-    attributes = ["usage", "generation", "feed", "key-acount-usage"]
-    df = pd.DataFrame(columns=attributes)
-    df_temp = pd.DataFrame(columns=attributes)
-    for distr_ele in elem.find("district"):
-        for f in distr_ele.getchildren():
-            value_list = []
-            for atr in attributes:
-                value_list.append(float(f.find(atr).text))
-            df_temp.loc[f.attrib["value"], attributes] = value_list
-            if n % 100 == 0:
-                df = pd.concat([df, df_temp])
-                df_temp = pd.DataFrame(columns=attributes)
+    district = None
+    path = []
+    for event, elem in ElementTree.iterparse(filename, ("start", "end")):
+        if event == "start":
+            if len(path) == 1 and district is None and elem.tag == "district":
+                district = elem
+            path.append(elem)
+            continue
+        path.pop()
+        if len(path) == 3 and path[1] is district:
+            if n == size:
+                size *= 2
+                values.resize((size, len(attributes)), refcheck=False)
+                index.resize(size, refcheck=False)
+            for i, atr in enumerate(attributes):
+                values[n, i] = float(elem.find(atr).text)
+            index[n] = elem.attrib["value"]
             n += 1
-    df = pd.concat([df, df_temp])
+            # Free the memory of the parsed time step.
+            elem.clear()
+            path[-1].remove(elem)
+        elif len(path) == 2:
+            # Free the memory of all parsed elements.
+            path[1].clear()
+    return pd.DataFrame(values[:n], index=index[:n], columns=attributes)
+
+
+def convert_net_xml2df(year, filename, hourly=True):
+    logging.info("Convert xml-file to csv-file for {0}".format(year))
+    df = read_net_xml(filename)
 
     # fill the data gaps
-    df = fill_data_gaps(df)
+    df, gap_report = fill_data_gaps(df, report=True)
+    logging.info("Gaps in the grid data:\n{0}".format(gap_report))
 
     # cut the time series to the given year
     start_date = datetime.datetime(year, 1, 1)
@@ -78,6 +164,18 @@ def convert_net_xml2df(year, filename, hourly=True):
     return df
 
 
+def grid_data_filename(year, district=None, ftype="xml"):
+    """Full name of a grid data file (xml, csv or hdf) of a district."""
+    if district is None:
+        district = "berlin"
+    return os.path.join(
+        cfg.get("paths", "electricity"),
+        cfg.get("electricity", "file_{0}".format(ftype)).format(
+            year=year, district=district.replace("-", "_")
+        ),
+    )
+
+
 def get_electricity_demand(year, hourly=True, district=None):
     """Get the electricity demand in MW.
 
@@ -97,20 +195,9 @@ def get_electricity_demand(year, hourly=True, district=None):
     -------
     pandas.DataFrame
     """
-    if district is None:
-        district_name = "berlin"
-    else:
-        district_name = district.replace("-", "_")
-
-    xml_filename = os.path.join(
-        cfg.get("paths", "electricity"),
-        cfg.get("electricity", "file_xml").format(
-            year=year, district=district_name
-        ),
-    )
-    csv_filename = os.path.join(
-        cfg.get("paths", "electricity"), cfg.get("electricity", "file_csv")
-    ).format(year=year, district=district_name)
+    xml_filename = grid_data_filename(year, district, "xml")
+    csv_filename = grid_data_filename(year, district, "csv")
+    hdf_filename = grid_data_filename(year, district, "hdf")
 
     if not os.path.isfile(xml_filename):
         logging.info(
@@ -120,22 +207,133 @@ def get_electricity_demand(year, hourly=True, district=None):
             year, district=district
         )
 
-    if not os.path.isfile(csv_filename):
-        df = convert_net_xml2df(year, xml_filename, hourly=hourly)
-        df.to_csv(csv_filename)
+    # The binary cache is only valid for the xml-file it was created from.
+    # The hourly and the original values are stored with different keys.
+    key = "hourly" if hourly else "raw"
+    xml_stat = os.stat(xml_filename)
+    source = pd.Series(
+        {
+            "mtime": float(xml_stat.st_mtime),
+            "size": float(xml_stat.st_size),
+            "hourly": float(hourly),
+        }
+    )
+    if os.path.isfile(hdf_filename):
+        with pd.HDFStore(hdf_filename, mode="r") as store:
+            source_key = key + "_source"
+            if source_key in store and source.equals(store[source_key]):
+                return store[key]
+
+    if not berlin_hp.download.verify_checksum(xml_filename):
+        logging.warning(
+            "Checksum of {0} does not match. Download file again.".format(
+                xml_filename
+            )
+        )
+        xml_filename = berlin_hp.download.get_berlin_net_data(
+            year, district=district
+        )
+        source["mtime"] = os.path.getmtime(xml_filename)
+        source["size"] = float(os.path.getsize(xml_filename))
+
+    # The csv-file contains the values of the last conversion, hourly or not.
+    df = None
+    if (
+        os.path.isfile(csv_filename)
+        and os.path.getmtime(csv_filename) >= source["mtime"]
+    ):
+        df = read_demand_csv(csv_filename)
+        if is_hourly(df.index) != hourly:
+            df = None
+    if df is None:
+        convert_net_xml2df(year, xml_filename, hourly=hourly).to_csv(
+            csv_filename
+        )
+        df = read_demand_csv(csv_filename)
 
+    with pd.HDFStore(hdf_filename, mode="a") as store:
+        store[key] = df
+        store[key + "_source"] = source
+    return df
+
+
+def read_demand_csv(filename):
+    """Read the electricity demand from the csv-file and convert it to MW."""
     msg = (
         "The unit for the electricity demand of the source is kW. Values "
         "will be divided by 1000 to get MW."
     )
     logging.warning(msg)
 
-    df = pd.read_csv(csv_filename, index_col=[0]).div(1000)
+    df = pd.read_csv(filename, index_col=[0]).div(1000)
     return df.set_index(
         pd.to_datetime(df.index, utc=True).tz_convert("Europe/Berlin")
     )
 
 
+def is_hourly(index):
+    """Check if the time steps of a datetime index are at least one hour."""
+    if len(index) < 2:
+        return True
+    return (index[1:] - index[:-1]).min() >= pd.Timedelta(hours=1)
+
+
+def get_electricity_demand_batch(
+    years, districts=None, column="usage", hourly=True, max_workers=None
+):
+    """Get the electricity demand in MW of several districts and years.
+
+    Missing xml-files are downloaded concurrently and the conversion runs
+    in a process pool.
+
+    Parameters
+    ----------
+    years : list
+        Years of the data sets.
+    districts : list or None
+        Districts of Berlin (see get_electricity_demand). Use 'berlin' for
+        the whole city. If None only 'berlin' is used.
+    column : str
+        Column of the grid data (usage, generation, feed, key-acount-usage).
+    hourly : bool
+        Get hourly data.
+    max_workers : int or None
+        Maximal number of processes to convert the xml-files.
+
+    Returns
+    -------
+    pandas.DataFrame : One column for each distinct (district, year) with
+        the time step of the year as index.
+    """
+    if districts is None:
+        districts = ["berlin"]
+    # Repeated districts or years are requested and converted only once.
+    keys = list(dict.fromkeys((d, y) for d in districts for y in years))
+    queries = [(y, None if d == "berlin" else d) for d, y in keys]
+
+    missing = [
+        q for q in queries if not os.path.isfile(grid_data_filename(*q))
+    ]
+    if len(missing) > 0:
+        logging.info("Download {0} grid data files.".format(len(missing)))
+        berlin_hp.download.get_berlin_net_data_batch(missing)
+
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            get_electricity_demand,
+            [q[0] for q in queries],
+            [hourly] * len(queries),
+            [q[1] for q in queries],
+        )
+        demand = {
+            key: df[column].reset_index(drop=True)
+            for key, df in zip(keys, results)
+        }
+    demand = pd.concat(demand, axis=1)
+    demand.columns.names = ["district", "year"]
+    return demand
+
+
 if __name__ == "__main__":
     logger.define_logging(file_level=logging.INFO)
     d_list = [
@@ -1,6 +1,8 @@
 import os
 import logging
+from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 
 import pandas as pd
 import geopandas as gpd
@@ -26,34 +28,37 @@ def stopwatch():
     return str(datetime.now() - stopwatch.start)[:-7]
 
 
-def create_scenario(year):
-    table_collection = {}
-
-    logging.info('BASIC SCENARIO - FEED-IN TIME SERIES')
-    table_collection['time_series'] = scenario_feedin(year)
-
-    logging.info('BASIC SCENARIO - HEAT DEMAND TIME SERIES')
-    table_collection['time_series'] = scenario_heat_profiles(
-        year, table_collection['time_series'])
-
-    logging.info('BASIC SCENARIO - DEMAND')
-    table_collection['time_series'] = scenario_elec_demand(
-        year, table_collection['time_series'])
-
-    logging.info('BASIC SCENARIO - POWER PLANTS')
-    table_collection['powerplants'] = scenario_powerplants(
-        year, table_collection['time_series'])
-
-    logging.info('BASIC SCENARIO - DECENTRALISED HEAT')
-    table_collection['decentralised_heating'] = decentralised_heating()
-
-    logging.info('BASIC SCENARIO - SOURCES')
-    table_collection['commodity_sources'] = commodity_sources(year)
-
-    logging.info('BASIC SCENARIO - VOLATILE SOURCES')
-    table_collection['volatile_source'] = scenario_volatile_sources()
-
-    return table_collection
+def create_scenario(year, max_workers=None, processes=None):
+    """Create the tables of the Friedrichshagen scenario of a year.
+
+    The power plants need the district heating demand, all other tables are
+    independent (see scenario_tools.build_tables). The builders that use hdf5
+    files or the reegis data (feed-in, heat and electricity demand, volatile
+    sources) run one after another unless they run in `processes` processes.
+    """
+    builder = scenario_tools.TableBuilder
+    builders = OrderedDict([
+        ('feedin', builder(
+            'time_series', partial(scenario_feedin, year), [], hdf=True)),
+        ('heat_profiles', builder(
+            'time_series', partial(scenario_heat_profiles, year, None), [],
+            hdf=True)),
+        ('elec_demand', builder(
+            'time_series', partial(scenario_elec_demand, year, None), [],
+            hdf=True)),
+        ('powerplants', builder(
+            'powerplants', partial(scenario_powerplants, year),
+            ['heat_profiles'])),
+        ('decentralised_heating', builder(
+            'decentralised_heating', decentralised_heating, [])),
+        ('commodity_sources', builder(
+            'commodity_sources', partial(commodity_sources, year), [])),
+        ('volatile_source', builder(
+            'volatile_source', scenario_volatile_sources, [], hdf=True)),
+    ])
+    logging.info('FRIEDRICHSHAGEN SCENARIO - {0}'.format(year))
+    return scenario_tools.build_tables(
+        builders, max_workers=max_workers, processes=processes)
 
 
 def time_logger(txt, ref):
@@ -175,8 +180,9 @@ def scenario_heat_profiles(year, ts, basic_scenario=True):
         if '_' in col:
             df[(dh_name, col)] = df[(dc_name, col)]
             del df[(dc_name, col)]
-
-    df = pd.concat([ts, df], axis=1)
+    df.reset_index(drop=True, inplace=True)
+    if ts is not None:
+        df = pd.concat([ts, df], axis=1)
     if basic_scenario is True:
         df['decentralised_demand', 'elec'] = 0
     return df
@@ -184,6 +190,9 @@ def scenario_heat_profiles(year, ts, basic_scenario=True):
 
 def scenario_elec_demand(year, time_series):
     elec_demand = calculate_elec_demand_friedrichshagen(year)
+    if time_series is None:
+        time_series = pd.DataFrame(
+            columns=pd.MultiIndex(levels=[[], []], codes=[[], []]))
     time_series['electricity', 'demand'] = elec_demand.values * 1000
     return time_series
 
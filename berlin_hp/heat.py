@@ -10,37 +10,66 @@ __copyright__ = "Uwe Krien <krien@uni-bremen.de>"
 __license__ = "MIT"
 
 # Python libraries
+import hashlib
+import json
 import logging
 import os
 import datetime
+import tempfile
+import weakref
+from collections import OrderedDict
 
 # External libraries
+import numpy as np
 import pandas as pd
 from workalendar.europe import Germany
 
 # oemof packages
 import oemof.tools.logger as logger
+import demandlib
 import demandlib.bdew as bdew
 
 # internal modules
 from reegis import config as cfg
-from reegis import energy_balance
-from reegis import demand_heat
 import reegis.coastdat
-import reegis.energy_balance
 import reegis.geometries
-import reegis.bmwi
+import berlin_hp.artifacts
+import berlin_hp.balance
 import berlin_hp.my_open_e_quarter
 
 
+# Memory cache of the building tables (see get_building_data)
+BUILDING_DATA = OrderedDict()
+
+# Memory cache of the normalised heat load profiles
+SHLP_PROFILES = {}
+
+# Parameters of the bdew heat load profiles
+SHLP_PARAMETERS = {'wind_class': 0, 'annual_heat_demand': 1000,
+                   'ww_incl': True}
+
+# Memory cache of the scaling factors of the building tables
+# (see get_heat_demand_factors)
+HEAT_DEMAND_FACTORS = {}
+
+# Levels of the LOR (lebensweltlich orientierte Räume)
+LOR_LEVELS = {'bezirk': 1,
+              'prognoseraum': 2,
+              'bezirksregion': 3,
+              'planungsraum': 4}
+
+
 def load_heat_data(filename=None, method='oeq', fill_frac_column=True,
                    region='berlin'):
     if method == 'oeq':
         if filename is None:
-            filename = cfg.get('oeq', 'results').format(region=region)
-        fn = os.path.join(cfg.get('paths', 'oeq'), filename)
-        if not os.path.isfile(fn):
-            berlin_hp.my_open_e_quarter.oeq()
+            if region == 'berlin':
+                region = None
+            fn = berlin_hp.artifacts.get('oeq_results', bzr=region)
+        else:
+            fn = os.path.join(cfg.get('paths', 'oeq'), filename)
+            if not os.path.isfile(fn):
+                berlin_hp.artifacts.get('oeq_results', bzr=None)
         data = pd.read_hdf(fn, method)
 
     elif method == 'wt':
@@ -52,46 +81,70 @@ def load_heat_data(filename=None, method='oeq', fill_frac_column=True,
         data = None
 
     if fill_frac_column:
-        data = fill_fraction_column(data)
+        data = fill_fraction_column(data, inplace=True)
 
     return data
         
 
-def fill_fraction_column(data):
+def fill_fraction_column(data, inplace=False, dtype=np.float64,
+                         report=False):
+    """Convert the fuel percentages (frac_ columns) into fractions.
+
+    Rows with a sum above 0.95 are levelled to 1. Rows with a sum below 0.1
+    get the average fractions of the complete rows.
 
+    Parameters
+    ----------
+    data : pandas.DataFrame
+    inplace : bool
+        Change the columns of the given table instead of a copy.
+    dtype : numpy.dtype
+        Data type of the fraction columns (e.g. numpy.float32).
+    report : bool
+        If True the number of levelled, filled and incomplete rows is
+        returned as well.
+
+    Returns
+    -------
+    pandas.DataFrame or tuple
+    """
     # Get the columns with the fraction of the fuel
     frac_cols = [x for x in data.columns if 'frac_' in x]
 
     # Divide columns with 100 to get the fraction instead of percentage
-    data[frac_cols] = data[frac_cols].div(100)
-
-    # Sum up columns to check if the sum is 1.
-    data['check'] = data[frac_cols].sum(axis=1)
-
-    # Level columns if sum is between 0.95 and 1.
-    data.loc[data['check'] > 0.95, frac_cols] = (
-        data.loc[data['check'] > 0.95, frac_cols].multiply(
-            (1 / data.loc[data['check'] > 0.95, 'check']), axis=0))
-
-    # Update the check column.
-    data['check'] = data[frac_cols].sum(axis=1)
-
-    # Get the average values for each fraction
-    length = len(data.loc[round(data['check']) == 1, frac_cols])
-    s = data.loc[data['check'] > 0.95, frac_cols].sum() / length
+    frac = data[frac_cols].to_numpy(dtype=dtype) / 100
+
+    # Level rows if sum is above 0.95.
+    check = np.nansum(frac, axis=1)
+    complete = check > 0.95
+    frac[complete] *= (1 / check[complete])[:, np.newaxis]
+    check[complete] = np.nansum(frac[complete], axis=1)
+
+    # Add average values to the rows with a sum below 0.1.
+    length = np.count_nonzero(np.round(check) == 1)
+    missing = check < 0.1
+    frac[missing] += np.nansum(frac[complete], axis=0) / length
+
+    check = np.nansum(frac, axis=1)
+    check_sum = check.sum()
+    if check_sum > len(check) + 1 or check_sum < len(check) - 1:
+        logging.warning("The fraction columns do not equalise 1.")
 
-    # add average values if fraction is missing
-    data.loc[data['check'] < 0.1, frac_cols] = (
-            data.loc[data['check'] < 0.1, frac_cols] + s)
+    if not inplace:
+        data = data.copy()
+    for n, col in enumerate(frac_cols):
+        data[col] = frac[:, n]
 
-    # Update the check column.
-    data['check'] = data[frac_cols].sum(axis=1)
-    length = float(len(data['check']))
-    check_sum = data['check'].sum()
-    if check_sum > length + 1 or check_sum < length - 1:
-        logging.warning("The fraction columns do not equalise 1.")
+    if not report:
+        return data
 
-    return data
+    fraction_report = pd.Series({
+        'rows': len(check),
+        'levelled': np.count_nonzero(complete),
+        'filled': np.count_nonzero(missing),
+        'incomplete': len(check) - np.count_nonzero(complete | missing),
+        'check_sum': check_sum})
+    return data, fraction_report
 
 
 def demand_by(data, demand_column, heating_systems=None,
@@ -118,7 +171,7 @@ def demand_by(data, demand_column, heating_systems=None,
          should be removed to name the results. If the column is
          name "fraction_of_district_heating" the string could be
          "fraction_of_" to use just "district_heating" for the name
-         of the result column.
+         of the result column (second level of the columns).
     percentage : boolean
         True if the fraction of the heating system columns sums up
         to hundred instead of one.
@@ -135,55 +188,33 @@ def demand_by(data, demand_column, heating_systems=None,
     if building_types is None:
         building_types = {'all': '{0} == {0}'.format(demand_column)}
 
-    # Create an empty DataFrame with the same index as the data DataFrame
-    demand_by_building = pd.DataFrame(
-        index=data.index)
-
-    # Loop over the building types and use the condition to filter.
-    # The value from demand column is written into the new condition
-    # column if the condition  is true
-    for btype, condition in building_types.items():
-        demand_by_building.loc[data.query(
-            condition).index, btype] = (
-            data[demand_column][data.query(condition).index])
-
-    # Create an empty DataFrame with the same index as the data DataFrame
-    demand = pd.DataFrame(index=data.index)
-
-    # Get the columns from the buildings condition
-    loop_list = demand_by_building.keys()
-
     # If heating system is None do not filter.
     if heating_systems is None:
         heating_systems = []
-        loop_list = []
         logging.error(
             "Demand_by without heating systems is not implemented")
 
-    blist = list()
-    for btype in loop_list:
-        # Create renaming dictionary
-        rename_dict = {
-            col: 'demand_' + btype + '_' + col.replace(
-                remove_string, '')
-            for col in heating_systems}
-
-        # Multiply each buildings column with the heating system fraction
-        demand = demand.combine_first(
-            data[heating_systems].multiply(
-                demand_by_building[btype], axis='index').div(prz))
+    # Membership matrix (building x building type) from all conditions
+    member = np.column_stack(
+        [data.eval(condition).to_numpy(dtype=bool)
+         for condition in building_types.values()])
 
-        # Rename the columns
-        demand = demand.rename(columns=rename_dict)
+    # Demand of each building by building type and heating system as one
+    # broadcasted product (building x building type x heating system).
+    demand = data[demand_column].to_numpy(dtype=float)
+    frac = data[heating_systems].to_numpy(dtype=float) / prz
+    values = np.where(member[:, :, np.newaxis],
+                      demand[:, np.newaxis, np.newaxis] *
+                      frac[:, np.newaxis, :],
+                      np.nan)
 
-        # Create a list with name of building columns with
-        blist.extend(list((btype, )) * len(heating_systems))
-    hlist = heating_systems * len(set(blist))
-    multindex = pd.MultiIndex.from_tuples(list(zip(blist, hlist)),
-                                          names=['first', 'second'])
+    multindex = pd.MultiIndex.from_product(
+        [list(building_types.keys()),
+         [col.replace(remove_string, '') for col in heating_systems]],
+        names=['first', 'second'])
 
-    return pd.DataFrame(data=demand.as_matrix(), columns=multindex,
-                        index=data.index)
+    return pd.DataFrame(data=values.reshape(len(data), -1),
+                        columns=multindex, index=data.index)
 
 
 def dissolve(data, level, columns=None):
@@ -203,45 +234,62 @@ def dissolve(data, level, columns=None):
         Dissolved Column.
 
     """
-    if columns is None:
-        columns = list(data.columns)
+    results = dissolve_levels(data, [level], columns)[level]
+    results.index = results.index.astype(str).str.zfill(
+        get_lor_digits(level))
+    return results
 
-    data['lor'] = data['lor'].astype(str).str.zfill(8)
 
-    error_level = level
-    if isinstance(level, str):
-        trans_dict = {'bezirk': 1,
-                      'prognoseraum': 2,
-                      'bezirksregion': 3,
-                      'planungsraum': 4}
-        level = trans_dict.get(level)
+def dissolve_levels(data, levels=None, columns=None):
+    """Sum up columns for several LOR levels in one pass.
 
-    if level is None:
-        logging.error("Wrong level: {0}".format(error_level))
+    The LOR is converted into integer codes once. The buildings are summed
+    up for the finest level and every other level is summed up from the
+    level below. The given table is not changed.
 
-    level *= 2
-    results = data.groupby(data['lor'].str[:level])[columns].sum()
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Table with a 'lor' column (planungsraum).
+    levels : list or None
+        LOR levels as number or name (see dissolve). If None all levels
+        are used.
+    columns : string or list
+        Name of the column(s) in the given table. If None all columns
+        except 'lor' are used.
 
-    # self.annual_demand = results
-    return results
+    Returns
+    -------
+    dict : Dissolved table of each level with the integer code of the region
+        as index.
+
+    """
+    if levels is None:
+        levels = list(LOR_LEVELS)
+    if columns is None:
+        columns = [c for c in data.columns if c != 'lor']
+
+    codes = get_lor_code(data['lor'])
+    valid = codes >= 0
+
+    digits = sorted({get_lor_digits(level) for level in levels},
+                    reverse=True)
+    results = {}
+    previous = 8
+    current = data.loc[valid, columns]
+    current_codes = codes[valid]
+    for d in digits:
+        current = current.groupby(current_codes // 10 ** (previous - d)).sum()
+        current_codes = current.index.to_numpy()
+        results[d] = current
+        previous = d
+    return {level: results[get_lor_digits(level)] for level in levels}
 
 
 def get_end_energy_data(year, state='BE'):
     """End energy demand from energy balance (reegis)
     """
-    filename_heat_reference = os.path.join(
-        cfg.get('paths', 'oeq'), 'heat_reference_TJ_{0}_{1}.csv'.format(
-            year, state))
-
-    if not os.path.isfile(filename_heat_reference):
-        eb = energy_balance.get_usage_balance(
-            year=year, grouped=True)
-        end_energy_table = eb.loc[state]
-        end_energy_table.to_csv(filename_heat_reference)
-    else:
-        end_energy_table = pd.read_csv(filename_heat_reference, index_col=[0])
-
-    return end_energy_table
+    return berlin_hp.balance.get_usage_balance(year, state)
 
 
 def get_district_heating_areas():
@@ -266,7 +314,14 @@ def get_district_heating_areas():
 
 
 def create_standardised_heat_load_profile(shlp, year):
-    """
+    """Normalised heat load profiles (bdew) of the given types.
+
+    The profiles depend on the year (holidays), the shlp dictionary, the
+    average temperature of Berlin and the parameters of the calculation
+    (SHLP_PARAMETERS, version of demandlib). They are cached in memory for
+    each year and shlp dictionary and in [paths] shlp with a key of all
+    inputs, so a changed weather source creates new profiles. Use
+    clear_standardised_heat_load_profile_cache() to empty the memory cache.
 
     Parameters
     ----------
@@ -278,11 +333,68 @@ def create_standardised_heat_load_profile(shlp, year):
     pandas.DataFrame
 
     """
+    key = '{0}_{1}'.format(year, hashlib.md5(
+        json.dumps(shlp, sort_keys=True).encode()).hexdigest()[:12])
+    if key not in SHLP_PROFILES:
+        temperature = get_average_temperature(year)
+        inputs = hashlib.md5(json.dumps(
+            [shlp, SHLP_PARAMETERS, getattr(demandlib, '__version__', None)],
+            sort_keys=True).encode())
+        inputs.update(pd.util.hash_pandas_object(temperature).values)
+        filename = os.path.join(
+            cfg.get('paths', 'shlp'),
+            'shlp_{0}_{1}.hdf'.format(year, inputs.hexdigest()[:12]))
+        if os.path.isfile(filename):
+            SHLP_PROFILES[key] = pd.read_hdf(filename, 'shlp')
+        else:
+            profile_type = calculate_standardised_heat_load_profile(
+                shlp, year, temperature)
+            os.makedirs(cfg.get('paths', 'shlp'), exist_ok=True)
+            # A unique temporary file, so that concurrent processes do not
+            # write to the same file.
+            fd, part_file = tempfile.mkstemp(
+                suffix='.part', dir=os.path.dirname(filename))
+            os.close(fd)
+            try:
+                profile_type.to_hdf(part_file, 'shlp', mode='w')
+                os.replace(part_file, filename)
+            finally:
+                if os.path.isfile(part_file):
+                    os.remove(part_file)
+            SHLP_PROFILES[key] = profile_type
+    return SHLP_PROFILES[key].copy()
+
+
+def clear_standardised_heat_load_profile_cache():
+    """Remove all heat load profiles from the memory cache."""
+    SHLP_PROFILES.clear()
+
+
+def get_average_temperature(year):
+    """Average temperature of Berlin in degree Celsius (coastdat)."""
     avg_temp_berlin = (reegis.coastdat.federal_state_average_weather(
         year, 'temp_air')['BE'])
+    return avg_temp_berlin - 272.15
 
-    # Calculate the average temperature in degree Celsius
-    temperature = avg_temp_berlin - 272.15
+
+def calculate_standardised_heat_load_profile(shlp, year, temperature=None):
+    """
+
+    Parameters
+    ----------
+    shlp : dict
+    year : int
+    temperature : pandas.Series or None
+        Average temperature in degree Celsius. Defaults to the average
+        temperature of Berlin (see get_average_temperature).
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    if temperature is None:
+        temperature = get_average_temperature(year)
 
     # Fetch the holidays of Germany from the workalendar package
     cal = Germany()
@@ -293,47 +405,56 @@ def create_standardised_heat_load_profile(shlp, year):
         shlp_name = str(shlp_type)
         profile_type[shlp_name] = bdew.HeatBuilding(
             temperature.index, holidays=holidays, temperature=temperature,
-            shlp_type=shlp_type, wind_class=0,
+            shlp_type=shlp_type,
             building_class=shlp[shlp_type]['build_class'],
-            annual_heat_demand=1000,
-            name=shlp_name, ww_incl=True).get_bdew_profile()
+            name=shlp_name, **SHLP_PARAMETERS).get_bdew_profile()
     return profile_type
 
 
-def create_heat_profiles(year, region='berlin'):
-    """Create heat_profiles for the basic scenario as time series in MW.
+def get_building_data(region='berlin'):
+    """Heat demand of each building merged with the heat factor and the
+    district heating system (STIFT).
 
-    - district heating time series for the different district heating systems
-    - decentralised heating demand time series for different fuels
+    The tables are cached in memory, so further calls do not read any file.
+    The least recently used tables are removed if the cache exceeds
+    [oeq] building_cache_size (MB). The returned tables must not be
+    modified. Use clear_building_data_cache() to empty the cache.
 
     Parameters
     ----------
-    year : int
-        The year of the basic scenario.
     region : str or int
-        Region or LOR to load the heat data from.
+        Region of the OEQ results file ('berlin' or a bezirksregion).
 
     Returns
     -------
-    pandas.DataFrame
-
+    tuple : Building table, district heating areas (pandas.DataFrame) and
+        LOR index of the building table (see create_lor_index)
     """
-    logging.info("Creating heat profiles...")
+    filename_heat_factor = os.path.join(
+        cfg.get('paths', 'data_berlin'),
+        cfg.get('oeq', 'alkis_heat_factor_table'))
+    filename_dh_areas = os.path.join(
+        cfg.get('paths', 'data_berlin'),
+        cfg.get('district_heating', 'map_district_heating_areas'))
+    filename_oeq = berlin_hp.artifacts.get(
+        'oeq_results', bzr=None if region == 'berlin' else region)
 
-    # allocation of district heating systems (map) to groups (model)
-    district_heating_groups = cfg.get_dict('district_heating_systems')
+    # A changed source file invalidates the cached tables.
+    key = (region,) + tuple(
+        os.path.getmtime(f)
+        for f in (filename_oeq, filename_heat_factor, filename_dh_areas))
+    if key in BUILDING_DATA:
+        BUILDING_DATA.move_to_end(key)
+        return BUILDING_DATA[key]
 
     # A file with a heat factor for each building type of the alkis
     # classification. Buildings like garages etc get the heat-factor 0. It is
     # possible to define building factors between 0 and 1.
-    filename_heat_factor = os.path.join(
-        cfg.get('paths', 'data_berlin'),
-        cfg.get('oeq', 'alkis_heat_factor_table'))
     heat_factor = pd.read_csv(filename_heat_factor, index_col=[0])
     del heat_factor['gebaeude_1']
 
     # heat demand for each building from open_e_quarter
-    data = load_heat_data()
+    data = load_heat_data(filename=filename_oeq)
 
     # Every building has a block id from the block the building is located.
     # Every block that touches a district heating area has the STIFT (number)
@@ -350,28 +471,196 @@ def create_heat_profiles(year, region='berlin'):
 
     data = data[['block', 'lor', 'frac_elec', 'frac_district_heating',
                  'frac_gas', 'frac_oil', 'frac_coal', 'HLAC', 'HLAP', 'AHDC',
-                 'AHDP', 'my_total', 'check', 'gml_id', 'STIFT',
+                 'AHDP', 'my_total', 'gml_id', 'STIFT',
                  'heat_factor', 'ghd', 'mfh']]
 
     # Multiply the heat demand of the buildings with the heat factor
     data['total'] = data['my_total'] * data['heat_factor']
     data['lor'] = data.lor.apply(str)
 
-    # if region != 'berlin':
-    #     berlin_total = data.total.sum()
-    #     data['lor'] = data.lor.apply(str)
-    #     data = data.loc[data.lor.str.startswith(str(region))]
-    #     region_factor = data.total.sum() / berlin_total
-    # else:
-    #     region_factor = 1
- 
+    # Sort the buildings by their LOR code, so that every region of every
+    # LOR level is a continuous range of rows.
+    data['lor_code'] = get_lor_code(data['lor'])
+    data = data.sort_values('lor_code', kind='mergesort')
+    lor_index = create_lor_index(data['lor_code'].values)
+
+    tables = (data, distr_heat_areas, lor_index)
+    BUILDING_DATA[key] = tables
+
+    # Remove the least recently used tables if the cache is too big.
+    max_size = cfg.get('oeq', 'building_cache_size') * 1024 ** 2
+    size = {k: sum(t.memory_usage(deep=True).sum() for t in v[:2])
+            for k, v in BUILDING_DATA.items()}
+    while sum(size.values()) > max_size and len(BUILDING_DATA) > 1:
+        del size[BUILDING_DATA.popitem(last=False)[0]]
+    return tables
+
+
+def get_lor_digits(level):
+    """Number of digits of a LOR level given by its number (1-4) or name.
+    """
+    if isinstance(level, str):
+        level = LOR_LEVELS.get(level)
+    if level not in (1, 2, 3, 4):
+        raise ValueError("Wrong level: {0}".format(level))
+    return level * 2
+
+
+def get_lor_code(lor):
+    """Integer code of the LOR (planungsraum). Missing values get -1."""
+    return pd.to_numeric(lor, errors='coerce').fillna(-1).astype(
+        np.int64).to_numpy()
+
+
+def get_lor_level(region):
+    """Number of digits of the LOR level of a region code.
+
+    2 = bezirk, 4 = prognoseraum, 6 = bezirksregion, 8 = planungsraum. The
+    leading zero of the code may be missing (e.g. 90517 = '090517').
+    """
+    return (len(str(int(region))) + 1) // 2 * 2
+
+
+def create_lor_index(lor_codes):
+    """Create the codes of all LOR levels from sorted planungsraum codes.
+
+    Parameters
+    ----------
+    lor_codes : numpy.ndarray
+        Sorted integer codes of the planungsraum (8 digits).
+
+    Returns
+    -------
+    dict : Sorted integer codes of each level (number of digits as key).
+    """
+    return {d: lor_codes // 10 ** (8 - d) for d in (2, 4, 6, 8)}
+
+
+def get_lor_rows(lor_index, region):
+    """Range of rows of a LOR region in a table sorted by the LOR code.
+
+    Parameters
+    ----------
+    lor_index : dict
+        See create_lor_index.
+    region : int or str
+        Code of the region of any LOR level.
+
+    Returns
+    -------
+    slice
+    """
+    codes = lor_index[get_lor_level(region)]
+    return slice(np.searchsorted(codes, int(region), side='left'),
+                 np.searchsorted(codes, int(region), side='right'))
+
+
+def clear_building_data_cache():
+    """Remove all building tables and their scaling factors from the memory
+    cache."""
+    BUILDING_DATA.clear()
+    HEAT_DEMAND_FACTORS.clear()
+
+
+def split_heat_demand(end_energy, heat_process):
+    """Split the end energy of the sectors into process and building heat.
+
+    The arrays may have additional leading dimensions (e.g. years or
+    scenarios) to split a batch of energy balances at once.
+
+    Parameters
+    ----------
+    end_energy : pandas.DataFrame or numpy.ndarray
+        End energy (TJ) of each sector (rows) and fuel (columns). An array
+        has the shape (..., sector, fuel).
+    heat_process : pandas.Series or numpy.ndarray
+        Fraction of process heat of each sector. An array has the shape
+        (..., sector).
+
+    Returns
+    -------
+    pandas.DataFrame or numpy.ndarray : Heat demand (MWh) with the rows
+        'process' and 'building' and the fuels as columns. An array has the
+        shape (..., 2, fuel).
+    """
+    if isinstance(end_energy, pd.DataFrame):
+        values = split_heat_demand(
+            end_energy.values.astype(float),
+            heat_process.loc[end_energy.index].values.astype(float))
+        return pd.DataFrame(values, index=['process', 'building'],
+                            columns=end_energy.columns)
+    heat_process = np.asarray(heat_process)[..., np.newaxis]
+    fractions = np.stack([heat_process, 1 - heat_process], axis=-3)
+    return (fractions * end_energy[..., np.newaxis, :, :]).sum(
+        axis=-2) / 3.6 * 1000000
+
+
+def remove_small_shares(values, threshold=None):
+    """Remove the small shares of each row and add them to the other ones.
+
+    Values below `threshold` times the sum of the row are set to zero and
+    their sum is distributed proportionally over the remaining values of
+    the row.
+
+    Parameters
+    ----------
+    values : pandas.DataFrame or numpy.ndarray
+        Values with the fuels in the last dimension (columns).
+    threshold : float or None
+        Minimal share. Defaults to the 'small_share' of the 'heating'
+        section of the config file.
+
+    Returns
+    -------
+    pandas.DataFrame or numpy.ndarray
+    """
+    if isinstance(values, pd.DataFrame):
+        return pd.DataFrame(
+            remove_small_shares(values.values.astype(float), threshold),
+            index=values.index, columns=values.columns)
+    if threshold is None:
+        threshold = cfg.get('heating', 'small_share')
+    total = values.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        small = values / total < threshold
+        rest = np.where(small, values, 0).sum(axis=-1, keepdims=True)
+        values = np.where(small, 0, values)
+        total = values.sum(axis=-1, keepdims=True)
+        return values + np.where(total != 0, values / total * rest, 0)
+
+
+def get_heat_demand_factors(year, data):
+    """Factors to scale the heat demand of the buildings to the heat demand
+    of the energy balance of Berlin.
+
+    The factors depend on the heat demand of all buildings of the table, so
+    they are calculated once for each year and building table and kept in
+    memory as long as the building table exists.
+
+    Parameters
+    ----------
+    year : int
+        The year of the energy balance.
+    data : pandas.DataFrame
+        Building table of Berlin (see get_building_data).
+
+    Returns
+    -------
+    dict : Fuel of each frac_ column ('fuels'), scaling factor of each fuel
+        ('factor'), fuels with a heat demand ('used') and the process heat
+        of each of these fuels ('process').
+    """
+    key = (year, id(data))
+    if key in HEAT_DEMAND_FACTORS and HEAT_DEMAND_FACTORS[key][0]() is data:
+        return HEAT_DEMAND_FACTORS[key][1]
+
     # Level the overall heat demand with the heat demand from the energy
     # balance. Get energy balance first.
-    end_energy_table = demand_heat.heat_demand(year).loc['BE']
+    end_energy_table = berlin_hp.balance.get_heat_demand(year, 'BE')
 
     # bmwi_table = reegis.bmwi.read_bmwi_sheet_7()
-    tab_a = reegis.bmwi.read_bmwi_sheet_7('a')
-    tab_b = reegis.bmwi.read_bmwi_sheet_7('b')
+    tab_a = berlin_hp.balance.get_bmwi_sheet_7('a')
+    tab_b = berlin_hp.balance.get_bmwi_sheet_7('b')
 
     # calculate the fraction of process energy and building heat (with dhw)
     heat_process = {}
@@ -396,90 +685,112 @@ def create_heat_profiles(year, region='berlin'):
         tab_a.loc[(s, r, r), 2014] +
         tab_a.loc[(s, w, w), 2014]))
 
-    # multiply the energy balance with the building/process fraction
-    profile_type = pd.DataFrame(columns=end_energy_table.columns)
-    profile_type.loc['process'] = 0
-    profile_type.loc['building'] = 0
-    for key in end_energy_table.index:
-        profile_type.loc['process'] += (
-                end_energy_table.loc[key] * heat_process[key] / 3.6 * 1000000)
-        profile_type.loc['building'] += (
-                end_energy_table.loc[key] * (1 - heat_process[key]) /
-                3.6 * 1000000)
-
-    # remove values below 1,5% and add it to the other values proportionally
-    for pt in profile_type.index:
-        s = profile_type.loc[pt].sum()
-        r = 0
-        for col in profile_type.columns:
-            if profile_type.loc[pt, col] / s < 0.015:
-                r += profile_type.loc[pt, col]
-                profile_type.loc[pt, col] = 0
-        s = profile_type.loc[pt].sum()
-        profile_type.loc[pt] = (
-                profile_type.loc[pt] + profile_type.loc[pt].div(s).multiply(r))
+    # multiply the energy balance with the building/process fraction and
+    # remove small shares
+    profile_type = remove_small_shares(
+        split_heat_demand(end_energy_table, pd.Series(heat_process)))
 
-    # Create a dictionary for each demand profile group
-    shlp = {'ghd': {'build_class': 0},
-            'mfh': {'build_class': 1}}
-    fuels = []
-
-    # Create a table with absolute heat demand for each fuel and each sector
-    # Industrial building heat will be treated as retail
+    # Heat demand of all buildings by fuel. The sectors are summed up per
+    # building first, so the (building x fuel x sector) matrix of the whole
+    # city is not needed.
     frac_cols = [x for x in data.columns if 'frac_' in x]
-    two_level_columns = pd.MultiIndex(levels=[[], []], codes=[[], []])
-    abs_data = pd.DataFrame(index=data.index, columns=two_level_columns)
-    for col in frac_cols:
-        for t in ['ghd', 'mfh']:
-            c = col.replace('frac_', '').replace('_', ' ').replace(
-                'gas', 'natural gas')
-            abs_data[c, t] = data[col].multiply(data['total'] *
-                                                data[t], axis=0)
+    fuels = [col.replace('frac_', '').replace('_', ' ').replace(
+        'gas', 'natural gas') for col in frac_cols]
+    weights = np.nansum(
+        data[['ghd', 'mfh']].values * data['total'].values[:, np.newaxis],
+        axis=1)
+    fuel_sum = np.nansum(data[frac_cols].values * weights[:, np.newaxis],
+                         axis=0)
 
     # Calculate a reduction factor for each fuel type. As there is no data
     # of electricity used for heating purpose an overall factor is used for
     # electricity.
-    factor = {'elec': (profile_type.loc['building'].sum() /
-                       abs_data.sum().sum())}
-    for fuel in abs_data.columns.get_level_values(0).unique():
-        if fuel not in factor and fuel in profile_type.columns:
-            factor[fuel] = (profile_type.loc['building', fuel] /
-                            abs_data[fuel].sum().sum())
-        elif fuel not in factor and fuel not in profile_type.columns:
-            factor[fuel] = 0
-
-        abs_data[fuel] *= factor[fuel]
-        if abs_data[fuel].sum().sum() > 0:
-            fuels.append(fuel)
+    factor = np.array([
+        profile_type.loc['building', fuel] if fuel in profile_type.columns
+        else 0 for fuel in fuels], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor /= fuel_sum
+        if 'elec' in fuels:
+            factor[fuels.index('elec')] = (
+                profile_type.loc['building'].sum() / fuel_sum.sum())
+        used = np.nan_to_num(fuel_sum * factor) > 0
+    used = [fuel for fuel, u in zip(fuels, used) if u]
+
+    # Process heat of the used fuels, that is distributed equally over all
+    # buildings of the city.
+    proc = [fuel for fuel in used if fuel in profile_type.columns]
+    factors = {
+        'fuels': fuels,
+        'factor': factor,
+        'used': used,
+        'process': profile_type.loc['process', proc].astype(float) / len(data),
+    }
+
+    # Remove the factors of building tables that do not exist anymore.
+    for k in [k for k, v in HEAT_DEMAND_FACTORS.items() if v[0]() is None]:
+        del HEAT_DEMAND_FACTORS[k]
+    HEAT_DEMAND_FACTORS[key] = (weakref.ref(data), factors)
+    return factors
+
+
+def get_annual_heat_demand(year, data, rows=None):
+    """Annual heat demand of each building by fuel and sector.
+
+    The heat demand of the buildings is scaled to the heat demand of the
+    energy balance of Berlin. The process heat of each fuel is distributed
+    equally over all buildings (sector 'proc').
 
-    # Create normalised heat load profiles (shlp) for each sector
-    norm_heat_profiles = create_standardised_heat_load_profile(shlp, year)
-    norm_heat_profiles['proc'] = 1000 / len(norm_heat_profiles)
+    Parameters
+    ----------
+    year : int
+        The year of the energy balance.
+    data : pandas.DataFrame
+        Building table of Berlin (see get_building_data).
+    rows : slice or None
+        Rows of the buildings to return (see get_lor_rows). The scaling
+        factors of the whole table are cached (see get_heat_demand_factors),
+        so the run time only depends on the number of the selected rows. If
+        None all buildings are returned.
 
-    heat_profiles = pd.DataFrame(index=norm_heat_profiles.index,
-                                 columns=two_level_columns)
+    Returns
+    -------
+    tuple : Heat demand (pandas.DataFrame) with (fuel, sector) columns and
+        the list of fuels with a heat demand.
+    """
+    factors = get_heat_demand_factors(year, data)
+    if rows is not None:
+        data = data.iloc[rows]
 
-    # Create a summable column for each demand group for district heating
-    for fuel in fuels:
-        if fuel in profile_type.columns:
-            abs_data[fuel, 'proc'] = (
-                profile_type.loc['process', fuel] / len(abs_data))
+    # Create a table with absolute heat demand for each fuel and each sector
+    # Industrial building heat will be treated as retail.
+    # (building x fuel) fractions times (building x sector) demand
+    frac_cols = [x for x in data.columns if 'frac_' in x]
+    sectors = ['ghd', 'mfh']
+    weights = data[sectors].values * data['total'].values[:, np.newaxis]
+    building = (data[frac_cols].values[:, :, np.newaxis] *
+                weights[:, np.newaxis, :])
+    with np.errstate(invalid='ignore'):
+        building *= factors['factor'][np.newaxis, :, np.newaxis]
 
-    if region != 'berlin':
-        abs_data = abs_data.loc[data.lor.str.startswith(str(region))]
+    columns = pd.MultiIndex.from_product([factors['fuels'], sectors])
 
-    for fuel in fuels:
-        for sector in abs_data[fuel].columns:
-            heat_profiles[fuel, sector] = norm_heat_profiles[sector].multiply(
-                abs_data[fuel, sector].sum())
+    # Create a summable column for each demand group for district heating
+    process = factors['process']
+    abs_data = pd.DataFrame(
+        np.hstack([
+            building.reshape(len(data), -1),
+            np.tile(process.values, (len(data), 1))]),
+        index=data.index,
+        columns=columns.append(
+            pd.MultiIndex.from_product([list(process.index), ['proc']])))
 
-    # ********* Multiplication with the region_factor !!!
-    # heat_profiles *= region_factor
-    # print('Region factor:', region_factor)
+    return abs_data, list(factors['used'])
 
-    # Group district heating by district heating systems (STIFT = id)
-    district_by_stift = data.loc[abs_data.index].groupby('STIFT').sum()
 
+def get_district_heating_group(data, distr_heat_areas):
+    """District heating group (see [district_heating_systems]) of each
+    building. Buildings outside a district heating area get nan.
+    """
     # Create translation Series with STIFT (numeric) and KLASSENNAM (text)
     stift2name = distr_heat_areas.groupby(
         ['STIFT', 'KLASSENNAM']).size().reset_index(
@@ -488,28 +799,153 @@ def create_heat_profiles(year, region='berlin'):
 
     # Group district heating by own definition (ini) of district heating
     # systems.
+    district_heating_groups = cfg.get_dict('district_heating_systems')
+    return data['STIFT'].map(stift2name).map(district_heating_groups)
 
-    district_groups = pd.DataFrame(
-        pd.concat([district_by_stift, stift2name], axis=1)).set_index(
-            'KLASSENNAM').groupby(by=district_heating_groups).sum()
 
-    # Calculate the fraction of each distric heating group.
+def create_heat_profiles(year, region='berlin'):
+    """Create heat_profiles for the basic scenario as time series in MW.
+
+    - district heating time series for the different district heating systems
+    - decentralised heating demand time series for different fuels
+
+    Parameters
+    ----------
+    year : int
+        The year of the basic scenario.
+    region : str or int
+        Region or LOR to load the heat data from.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    logging.info("Creating heat profiles...")
+
+    # heat demand, heat factor and district heating system of each building
+    data, distr_heat_areas, lor_index = get_building_data()
+
+    # heat demand of each building of the region by fuel and sector
+    if region == 'berlin':
+        rows = slice(None)
+    else:
+        rows = get_lor_rows(lor_index, region)
+    abs_data, fuels = get_annual_heat_demand(year, data, rows)
+    data = data.iloc[rows]
+
+    # Create a dictionary for each demand profile group
+    shlp = {'ghd': {'build_class': 0},
+            'mfh': {'build_class': 1}}
+
+    # Create normalised heat load profiles (shlp) for each sector
+    norm_heat_profiles = create_standardised_heat_load_profile(shlp, year)
+    norm_heat_profiles['proc'] = 1000 / len(norm_heat_profiles)
+
+    # Annual demand (fuel x sector) times the normalised profiles (time x
+    # sector) gives the profile of each fuel (time x fuel).
+    sectors = list(norm_heat_profiles.columns)
+    annual = abs_data.sum().unstack().reindex(
+        index=fuels, columns=sectors, fill_value=0).fillna(0)
+    profiles = norm_heat_profiles.values @ annual.values.T
+
+    # Group district heating by own definition (ini) of district heating
+    # systems and calculate the fraction of each district heating group.
+    dh_group = get_district_heating_group(data, distr_heat_areas)
+    district_groups = data.groupby(dh_group)['frac_district_heating'].sum()
     frac_district_groups = district_groups.div(district_groups.sum())
 
     # Create standardised heat load profile for each group
-    for nr in frac_district_groups.index:
-        for sector in heat_profiles['district heating'].columns:
-            heat_profiles[nr, sector] = (
-                heat_profiles['district heating', sector] *
-                frac_district_groups.loc[nr, 'frac_district_heating'])
-
+    dh = fuels.index('district heating')
+    other = [i for i in range(len(fuels)) if i != dh]
+    heat_profiles = pd.DataFrame(
+        np.hstack([
+            profiles[:, other],
+            profiles[:, [dh]] * frac_district_groups.values[np.newaxis, :]]),
+        index=norm_heat_profiles.index,
+        columns=[fuels[i] for i in other] + list(frac_district_groups.index))
     heat_profiles = heat_profiles.groupby(level=0, axis=1).sum()
-    del heat_profiles['district heating']
 
-    for c in heat_profiles.columns:
-        if heat_profiles[c].sum() == 0:
-            del heat_profiles[c]
+    heat_profiles = heat_profiles.loc[:, heat_profiles.sum() != 0]
+
+    return heat_profiles.div(1000000)
+
+
+def create_regional_heat_profiles(year, level='bezirksregion'):
+    """Create heat profiles (MW) for all regions of a LOR level at once.
+
+    The result for each region is the same as the result of
+    create_heat_profiles(year, region) but the annual demand of all regions
+    is summed up in one groupby and the profiles are created in one matrix
+    product with the normalised heat load profiles.
+
+    Parameters
+    ----------
+    year : int
+        The year of the basic scenario.
+    level : str or int
+        LOR level: 'bezirk', 'prognoseraum', 'bezirksregion',
+        'planungsraum' or the number of the level (1, 2, 3, 4).
 
+    Returns
+    -------
+    pandas.DataFrame : Time series with (region, profile) columns. Use
+        stack(0) to get a long-format table.
+    """
+    logging.info("Creating heat profiles for all regions ({0})...".format(
+        level))
+    digits = get_lor_digits(level)
+
+    data, distr_heat_areas, lor_index = get_building_data()
+    abs_data, fuels = get_annual_heat_demand(year, data)
+
+    shlp = {'ghd': {'build_class': 0},
+            'mfh': {'build_class': 1}}
+    norm_heat_profiles = create_standardised_heat_load_profile(shlp, year)
+    norm_heat_profiles['proc'] = 1000 / len(norm_heat_profiles)
+    sectors = list(norm_heat_profiles.columns)
+
+    # Annual demand of all regions by fuel and sector: (region, fuel, sector)
+    codes = lor_index[digits]
+    valid = codes >= 0
+    regional = abs_data[fuels].loc[valid].groupby(codes[valid]).sum()
+    regional = regional.reindex(
+        columns=pd.MultiIndex.from_product([fuels, sectors]), fill_value=0)
+    regions = regional.index
+    annual = regional.values.reshape(len(regions), len(fuels), len(sectors))
+
+    # Profiles of all regions and fuels: (time, region, fuel)
+    profiles = np.einsum('ts,rfs->trf', norm_heat_profiles.values, annual)
+
+    # Split district heating into the district heating groups per region.
+    dh_group = get_district_heating_group(data, distr_heat_areas)
+    district_groups = data.loc[valid].groupby(
+        [codes[valid], dh_group[valid]])['frac_district_heating'].sum()
+    district_groups = district_groups.unstack(fill_value=0).reindex(
+        regions, fill_value=0)
+    frac_district_groups = district_groups.div(
+        district_groups.sum(axis=1), axis=0).fillna(0)
+
+    other = [f for f in fuels if f != 'district heating']
+    columns = other + list(frac_district_groups.columns)
+    profiles = np.concatenate(
+        [profiles[:, :, [fuels.index(f) for f in other]],
+         profiles[:, :, [fuels.index('district heating')]] *
+         frac_district_groups.values[np.newaxis, :, :]],
+        axis=2)
+
+    # Sort the profiles by name and remove the empty profiles of each region.
+    order = np.argsort(columns)
+    columns = [columns[i] for i in order]
+    profiles = profiles[:, :, order]
+    used = profiles.sum(axis=0) != 0
+    region_idx, column_idx = np.nonzero(used)
+
+    heat_profiles = pd.DataFrame(
+        profiles[:, used],
+        index=norm_heat_profiles.index,
+        columns=pd.MultiIndex.from_arrays(
+            [regions[region_idx], [columns[i] for i in column_idx]]))
     return heat_profiles.div(1000000)
 
 
@@ -14,8 +14,10 @@ import logging
 import datetime
 import os
 import warnings
+from concurrent import futures
 
 # External libraries
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
@@ -29,6 +31,7 @@ except ModuleNotFoundError:
     be = None
 from reegis import config as cfg, geometries
 import berlin_hp.download as download
+import berlin_hp.artifacts as artifacts
 
 
 def process_alkis_buildings(shapefile_out, table, remove_non_heated=True):
@@ -44,12 +47,8 @@ def process_alkis_buildings(shapefile_out, table, remove_non_heated=True):
     -------
 
     """
-    path = os.path.join(cfg.get("paths", "fis_broker"), table, "shp")
-    shapefile_in = os.path.join(path, table + ".shp")
-
-    # Download shp_file if it does not exist
-    if not os.path.isfile(shapefile_in):
-        shapefile_in = download.download_maps(single="alkis")
+    # Download shp_file if it does not exist or is outdated
+    shapefile_in = artifacts.get("fis_broker_map", single="alkis")
 
     geo_table = gpd.read_file(shapefile_in)
 
@@ -90,14 +89,76 @@ def process_alkis_buildings(shapefile_out, table, remove_non_heated=True):
     return shapefile_out
 
 
+def assign_nearest_block(points, blocks, max_distance=None, step=0.00001):
+    """Find the nearest block for each point using a spatial index.
+
+    The result is the same as growing a buffer around each point by `step`
+    until it intersects a block: the block with the smallest number of steps
+    wins and ties are resolved by the order of the blocks table.
+
+    Parameters
+    ----------
+    points : geopandas.GeoDataFrame
+        Points (e.g. representative points of buildings) without a block.
+    blocks : geopandas.GeoDataFrame
+        Block polygons. All non-geometry columns are returned.
+    max_distance : float or None
+        Maximal search distance in units of the crs. If None the value of
+        `[fis_broker] max_block_distance` is used.
+    step : float
+        Step size of the buffer search in units of the crs.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Block data for all points with a block within `max_distance`,
+        indexed like `points`. The distance is stored in `block_dist`.
+
+    """
+    if max_distance is None:
+        max_distance = cfg.get("fis_broker", "max_block_distance")
+
+    block_cols = [c for c in blocks.columns if c != "geometry"]
+    if len(points) == 0:
+        return pd.DataFrame(columns=block_cols + ["block_dist"])
+
+    buffers = gpd.GeoDataFrame(
+        {"point_pos": range(len(points))},
+        geometry=points.geometry.buffer(max_distance).values,
+        crs=points.crs,
+    )
+    candidates = blocks[["geometry"]].copy()
+    candidates["block_pos"] = range(len(blocks))
+    pairs = pd.DataFrame(
+        gpd.sjoin(buffers, candidates, how="inner", op="intersects")
+    )[["point_pos", "block_pos"]]
+
+    pairs["block_dist"] = gpd.GeoSeries(
+        points.geometry.values[pairs["point_pos"].values]
+    ).distance(
+        gpd.GeoSeries(blocks.geometry.values[pairs["block_pos"].values])
+    ).values
+    pairs = pairs.loc[pairs["block_dist"] <= max_distance]
+    pairs["steps"] = np.ceil(pairs["block_dist"] / step).clip(lower=1)
+
+    pairs = pairs.sort_values(["point_pos", "steps", "block_pos"])
+    pairs = pairs.drop_duplicates("point_pos", keep="first")
+
+    result = pd.DataFrame(blocks[block_cols].iloc[pairs["block_pos"].values])
+    result.index = points.index[pairs["point_pos"].values]
+    result["block_dist"] = pairs["block_dist"].values
+    logging.info(
+        "Block found for {0} of {1} points. Maximal distance: {2}".format(
+            len(result), len(points), result["block_dist"].max()
+        )
+    )
+    return result
+
+
 def merge_maps():
     gdf = {}
 
-    table = "s_wfs_alkis_gebaeudeflaechen"
-    path = os.path.join(cfg.get("paths", "fis_broker"), table, "shp")
-    shapefile_alkis = os.path.join(path, table + "_prepared" + ".shp")
-    if not os.path.isfile(shapefile_alkis):
-        shapefile_alkis = process_alkis_buildings(shapefile_alkis, table)
+    shapefile_alkis = artifacts.get("alkis_prepared")
 
     tables = download.get_map_config()
 
@@ -116,16 +177,8 @@ def merge_maps():
 
     logging.info("Read tables to be joined: {0}.".format(tuple(cols.keys())))
     for t in ["block", "nutz", "ew"]:
-        tables[t]["path"] = os.path.join(
-            cfg.get("paths", "fis_broker"),
-            tables[t]["table"],
-            "shp",
-            tables[t]["table"] + ".shp",
-        )
+        tables[t]["path"] = artifacts.get("fis_broker_map", single=t)
         logging.debug("Reading {0}".format(tables[t]["path"]))
-
-        if not os.path.isfile(tables[t]["path"]):
-            tables[t]["path"] = download.download_maps(single=t)
         gdf[t] = gpd.read_file(tables[t]["path"])[cols[t] + ["geometry"]]
 
     logging.info("Spatial join of all tables...")
@@ -183,44 +236,23 @@ def merge_maps():
     alkis = gpd.sjoin(alkis, geoheiz, how="left", op="within")
     del alkis["index_right"]
 
-    logging.info("Add block data for non-matching points using buffers.")
-    remain = len(alkis.loc[alkis["PLR"].isnull()])
-    logging.info(
-        "This will take some time. Number of points: {0}".format(remain)
-    )
-
-    # I think it is possible to make this faster and more elegant but I do not
-    # not have the time to think about it. As it has to be done only once it
-    # is not really time-sensitive.
-    for row in alkis.loc[alkis["PLR"].isnull()].iterrows():
-        idx = int(row[0])
-        point = row[1].geometry
-        intersec = False
-        n = 0
-        block_id = 0
-        while not intersec and n < 500:
-            bi = block_j.loc[block_j.intersects(point.buffer(n / 100000))]
-            if len(bi) > 0:
-                intersec = True
-                bi = bi.iloc[0]
-                block_id = bi["SCHL5"]
-                del bi["geometry"]
-                alkis.loc[idx, bi.index] = bi
-            n += 1
-        remain -= 1
-
-        if intersec:
-            logging.info(
-                "Block found for {0}: {1}, Buffer: {2}. Remains: {3}".format(
-                    alkis.loc[idx, "gml_id"][-12:], block_id[-16:], n, remain
-                )
-            )
-        else:
-            warnings.warn(
-                "{0} does not intersect with any region. Please check".format(
-                    row[1]
-                )
+    logging.info("Add block data for non-matching points (nearest block).")
+    remain = alkis.loc[alkis["PLR"].isnull()]
+    logging.info("Number of points without block: {0}".format(len(remain)))
+
+    nearest = assign_nearest_block(remain, block_j)
+    block_cols = [c for c in block_j.columns if c != "geometry"]
+    alkis["block_dist"] = 0.0
+    alkis.loc[alkis["PLR"].isnull(), "block_dist"] = float("nan")
+    alkis.loc[nearest.index, block_cols] = nearest[block_cols]
+    alkis.loc[nearest.index, "block_dist"] = nearest["block_dist"]
+
+    for idx in remain.index.difference(nearest.index):
+        warnings.warn(
+            "{0} does not intersect with any region. Please check".format(
+                alkis.loc[idx, "gml_id"]
             )
+        )
 
     logging.info(
         "Check: Number of buildings without PLR attribute: {0}".format(
@@ -246,81 +278,342 @@ def merge_maps():
     return filename_shp
 
 
+def strip_prefix(column, prefix):
+    """Remove a prefix from all values of a string column."""
+    column = column.astype(str).where(column.notna())
+    has_prefix = column.str.startswith(prefix, na=False)
+    return column.where(~has_prefix, column.str.slice(len(prefix)))
+
+
+def infer_numeric(data):
+    """Convert text columns that contain only numbers to numeric columns."""
+    for col in data.columns[data.dtypes == object]:
+        numeric = pd.to_numeric(data[col], errors="coerce")
+        if numeric.notna().sum() == data[col].notna().sum():
+            data[col] = numeric
+    return data
+
+
 def convert_shp2table():
+    """Store the attributes and the geometry of the joined ALKIS map.
+
+    The attributes are stored as table (hdf5), the geometry as WKB in a
+    pickled pandas.Series, both with the gml_id as index.
+    """
     filename = {
         "hdf": os.path.join(
             cfg.get("paths", "fis_broker"),
             cfg.get("fis_broker", "alkis_joined_hdf"),
         ),
-        "csv": os.path.join(
-            cfg.get("paths", "fis_broker"),
-            cfg.get("fis_broker", "alkis_joined_csv"),
-        ),
         "geo": os.path.join(
             cfg.get("paths", "fis_broker"),
-            cfg.get("fis_broker", "alkis_geometry_csv"),
-        ),
-        "shp": os.path.join(
-            cfg.get("paths", "fis_broker"),
-            cfg.get("fis_broker", "alkis_joined_shp"),
+            cfg.get("fis_broker", "alkis_geometry_wkb"),
         ),
     }
 
-    if not os.path.isfile(filename["shp"]):
-        filename["shp"] = merge_maps()
+    filename["shp"] = artifacts.get("alkis_joined_shp")
     alkis = gpd.read_file(filename["shp"])
 
-    alkis.to_csv(filename["csv"])
-    data = pd.read_csv(filename["csv"], index_col=[0])
-    data["gml_id"] = data["gml_id"].str.replace(
-        "s_wfs_alkis_gebaeudeflaechen.", ""
+    geometry = alkis.pop("geometry")
+    data = infer_numeric(pd.DataFrame(alkis))
+    data["gml_id"] = strip_prefix(
+        data["gml_id"], "s_wfs_alkis_gebaeudeflaechen."
     )
-    data["SCHL5"] = data["SCHL5"].str.replace("s_ISU5_2015_UA.", "")
+    data["SCHL5"] = strip_prefix(data["SCHL5"], "s_ISU5_2015_UA.")
     data.set_index("gml_id", drop=True, inplace=True)
-    data["geometry"].to_csv(filename["geo"])
-    del data["geometry"]
 
-    data.to_csv(filename["csv"])
-    data.to_hdf(filename["hdf"], "alkis")
+    pd.Series(
+        gpd.array.to_wkb(geometry.values), index=data.index, name="geometry"
+    ).to_pickle(filename["geo"])
+    # The LOR codes are stored as data column to select the buildings of a
+    # region (see get_alkis_with_additional_data).
+    apply_schema(data).to_hdf(
+        filename["hdf"], "alkis", format="table", data_columns=["PLR"]
+    )
     return filename
 
 
-def get_alkis_with_additional_data():
-    filename_alkis = os.path.join(
-        cfg.get("paths", "fis_broker"),
-        cfg.get("fis_broker", "alkis_joined_hdf"),
+def get_alkis_geometry():
+    """Geometry of the ALKIS buildings with the gml_id as index."""
+    artifacts.get("alkis_joined_table")
+    wkb = pd.read_pickle(
+        os.path.join(
+            cfg.get("paths", "fis_broker"),
+            cfg.get("fis_broker", "alkis_geometry_wkb"),
+        )
     )
+    return gpd.GeoSeries(
+        gpd.array.from_wkb(wkb.values),
+        index=wkb.index,
+        crs={"init": "epsg:4326"},
+    )
+
 
-    if not os.path.isfile(filename_alkis):
-        filename_alkis = convert_shp2table()["hdf"]
+# Compact column types of the ALKIS and OEQ tables. All other float columns
+# (physical parameters of the buildings) are stored as float32, other object
+# columns as strings. The fuel shares and the heat demand are used to scale
+# the heat demand to the energy balance (see berlin_hp.heat), so they keep
+# their precision.
+DEMAND_COLUMNS = [
+    "PRZ_FERN",
+    "PRZ_GAS",
+    "PRZ_KOHLE",
+    "PRZ_NASTRO",
+    "PRZ_OEL",
+    "frac_district_heating",
+    "frac_gas",
+    "frac_coal",
+    "frac_elec",
+    "frac_oil",
+    "HLAC",
+    "HLAP",
+    "AHDC",
+    "AHDP",
+    "total_loss_pres",
+    "my_total",
+]
+
+TABLE_SCHEMA = {
+    "GFK": "category",
+    "BEZGFK": "category",
+    "TYPKLAR": "category",
+    "SCHL5": "category",
+    "PLR": np.int32,
+    "building_function": "category",
+    "building_function_name": "category",
+    "block_type_name": "category",
+    "block": "category",
+    "share_non_tilted_roof": "category",
+    "lor": np.int32,
+    **{col: np.float64 for col in DEMAND_COLUMNS},
+}
+
+
+def _to_text(column, numbers=False):
+    """Convert an object column that does not only contain strings to text.
+
+    If `numbers` is True, object columns that only contain numbers are kept
+    (e.g. as categories).
+    """
+    keep = ("string", "empty")
+    if numbers:
+        keep += ("integer", "floating")
+    if column.dtype == object and (
+        pd.api.types.infer_dtype(column, skipna=True) not in keep
+    ):
+        column = column.astype(str).where(column.notna())
+    return column
 
-    return pd.DataFrame(pd.read_hdf(filename_alkis, "alkis"))
 
+def get_categories(data, schema=None):
+    """Categories of the categorical columns of the schema in a table.
 
-def oeq(bzr=None):
-    start = datetime.datetime.now()
+    Pass them to apply_schema to get the same categories in all parts of a
+    table, which is necessary to append the parts to one hdf5 table.
+    """
+    if schema is None:
+        schema = TABLE_SCHEMA
+    return {
+        col: _to_text(data[col], numbers=True)
+        .astype("category")
+        .cat.categories
+        for col, dtype in schema.items()
+        if dtype == "category" and col in data
+    }
+
+
+def get_string_sizes(data, minimum=8):
+    """Maximal length of the strings in the text columns and the index.
+
+    Pass them as min_itemsize to HDFStore.append, so that later parts with
+    longer strings fit into the hdf5 table.
+    """
+    sizes = {}
+    for col in data.select_dtypes(include=["object", "category"]).columns:
+        column = data[col].astype(object)
+        length = _to_text(column).dropna().astype(str).str.len().max()
+        sizes[col] = max(int(0 if pd.isnull(length) else length), minimum)
+    if data.index.dtype == object:
+        length = data.index.astype(str).str.len().max()
+        sizes["index"] = max(int(0 if pd.isnull(length) else length), minimum)
+    return sizes
+
+
+def apply_schema(data, schema=None, categories=None):
+    """Convert the columns of a table to compact types.
+
+    Integer columns (LOR codes) get -1 for missing values. Float columns
+    that are not in the schema are stored as float32. Object columns
+    with mixed types are converted to strings, so that the table can be
+    stored in the 'table' format of HDF5.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+    schema : dict or None
+        Type of the columns. Defaults to TABLE_SCHEMA.
+    categories : dict or None
+        Fixed categories of the categorical columns (see get_categories).
+        Categorical columns of the schema that are missing in the dictionary
+        are stored as text. If None the categories are taken from the data.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if schema is None:
+        schema = TABLE_SCHEMA
+    before = data.memory_usage(deep=True).sum()
+    data = data.copy()
+    for col in data.columns:
+        dtype = schema.get(col)
+        column = data[col]
+        if dtype is not None and dtype != "category":
+            column = pd.to_numeric(column, errors="coerce")
+            if np.issubdtype(dtype, np.integer):
+                column = column.fillna(-1)
+            data[col] = column.astype(dtype)
+            continue
+        if dtype is None and column.dtype == np.float64:
+            data[col] = column.astype(np.float32)
+            continue
+        if dtype == "category" and (categories is None or col in categories):
+            column = _to_text(column, numbers=True)
+            if categories is None:
+                column = column.astype("category")
+            else:
+                column = pd.Categorical(column, categories=categories[col])
+        elif isinstance(column.dtype, pd.CategoricalDtype):
+            column = _to_text(column.astype(object))
+        else:
+            column = _to_text(column)
+        data[col] = column
+    after = data.memory_usage(deep=True).sum()
+    logging.info(
+        "Memory usage of the table: {0:.1f} MB -> {1:.1f} MB".format(
+            before / 2 ** 20, after / 2 ** 20
+        )
+    )
+    return data
+
+
+def get_alkis_with_additional_data(bzr=None):
+    """Joined ALKIS table of Berlin or of one district region.
+
+    Parameters
+    ----------
+    bzr : int or None
+        Code of a district region (Bezirksregion). Only the buildings of this
+        region are read from the file. Use None for Berlin.
+    """
+    filename_alkis = artifacts.get("alkis_joined_table")
+    if bzr is None:
+        where = None
+    elif bzr == 0:
+        where = "PLR < 100"
+    else:
+        where = "PLR >= {0} & PLR < {1}".format(bzr * 100, (bzr + 1) * 100)
+    data = pd.DataFrame(pd.read_hdf(filename_alkis, "alkis", where=where))
+    if bzr is not None:
+        data = data.loc[get_bzr_codes(data) == bzr]
+    return data
+
+
+def get_bzr_list():
+    """Codes of all district regions (Bezirksregionen) with buildings."""
+    filename_alkis = artifacts.get("alkis_joined_table")
+    with pd.HDFStore(filename_alkis, mode="r") as store:
+        plr = pd.DataFrame({"PLR": store.select_column("alkis", "PLR")})
+    return [int(r) for r in sorted(get_bzr_codes(plr).unique())]
+
+
+def get_bzr_codes(data):
+    """District region (Bezirksregion) of each building.
 
+    Buildings without a LOR code get the code 0.
+    """
+    plr = pd.to_numeric(data.PLR, errors="coerce")
+    return plr.where(plr >= 0).floordiv(100).fillna(0).astype(int)
+
+
+def oeq_results_filename(bzr=None):
     if bzr is None:
         reg = "berlin"
     else:
         reg = bzr
-
-    filename_oeq_results = os.path.join(
+    return os.path.join(
         cfg.get("paths", "oeq"), cfg.get("oeq", "results").format(region=reg)
     )
 
-    data = get_alkis_with_additional_data()
 
-    if bzr is not None:
-        data["BZR"] = data.PLR.div(100).astype(int)
-        data = data.loc[data.BZR == bzr]
+def get_lor_chunks(lor, chunk_size):
+    """Split the rows into chunks of whole planning areas (LOR).
 
-    data["alkis_id"] = data.index
+    The rows are ordered by their LOR code and the planning areas are
+    collected until a chunk exceeds `chunk_size` rows. A planning area with
+    more than `chunk_size` buildings forms a chunk of its own. The chunks
+    only depend on the codes and the chunk size, so they are reproducible.
 
-    sn_data = pd.read_csv(
-        os.path.join(cfg.get("paths", "data_berlin"), "data_by_blocktype.csv"),
-        ";",
-    )
+    Parameters
+    ----------
+    lor : pandas.Series
+        LOR code of each row.
+    chunk_size : int
+        Maximal number of rows of a chunk.
+
+    Returns
+    -------
+    list : Arrays with the positions of the rows of each chunk.
+    """
+    codes = pd.to_numeric(lor, errors="coerce").fillna(-1).to_numpy()
+    order = np.argsort(codes, kind="mergesort")
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    bounds = np.append(bounds, len(codes))
+    chunks = []
+    first = 0
+    last = 0
+    for bound in bounds:
+        if bound - first > chunk_size and last > first:
+            chunks.append(order[first:last])
+            first = last
+        last = bound
+    if last > first:
+        chunks.append(order[first:last])
+    return chunks
+
+
+# Replace ranges of the year of construction with one year.
+YEAR_OF_CONSTRUCTION = {
+    "1950-1979": 1964,
+    "ab 1945": 1970,
+    "1920-1939": 1929,
+    "1920-1949": 1934,
+    "1870-1918": 1894,
+    "bis 1945": 1920,
+    "1870-1945": 1908,
+    "1890-1930": 1910,
+    "1960-1989": 1975,
+    "ab 1990": 2003,
+    "1870-1899": 1885,
+    "bis 1869": 1860,
+    "1900-1918": 1909,
+    "1975-1992": 1984,
+    "1962-1974": 1968,
+    "1946-1961": 1954,
+    "1919-1932": 1926,
+    "1933-1945": 1939,
+    "None": None,
+    "NaN": None,
+    "nan": None,
+}
+
+
+def prepare_buildings(data, sn_data):
+    """Add the block type data to the ALKIS buildings and rename the columns
+    to the names of openEQuarter.
+    """
+    data = data.copy()
+    data["alkis_id"] = data.index
 
     data = data.merge(sn_data, on="TYPKLAR", how="left")
     data.set_index("alkis_id", drop=True, inplace=True)
@@ -347,60 +640,309 @@ def oeq(bzr=None):
     data["all_systems"] = 1
 
     # *** Year of construction ***
-    # Replace ranges with one year.
-    year_of_construction = {
-        "1950-1979": 1964,
-        "ab 1945": 1970,
-        "1920-1939": 1929,
-        "1920-1949": 1934,
-        "1870-1918": 1894,
-        "bis 1945": 1920,
-        "1870-1945": 1908,
-        "1890-1930": 1910,
-        "1960-1989": 1975,
-        "ab 1990": 2003,
-        "1870-1899": 1885,
-        "bis 1869": 1860,
-        "1900-1918": 1909,
-        "1975-1992": 1984,
-        "1962-1974": 1968,
-        "1946-1961": 1954,
-        "1919-1932": 1926,
-        "1933-1945": 1939,
-        "None": None,
-        "NaN": None,
-        "nan": None,
-    }
     # data['age_scan'].replace(year_of_construction, inplace=True)
-    data["building_age"] = data["building_age"].replace(year_of_construction)
+    data["building_age"] = data["building_age"].replace(YEAR_OF_CONSTRUCTION)
 
     # Fill all remaining nan values with a default value of 1960
     data["year_of_construction"] = data["building_age"].fillna(1960)
+    return data
+
+
+def oeq(bzr=None, chunk_size=None):
+    """Calculate the heat demand of the buildings with openEQuarter.
+
+    The buildings are read, evaluated and stored in chunks of whole LOR
+    regions, so only one chunk of the ALKIS table is held in memory. The
+    results of each chunk are stored in a temporary file, so an interrupted
+    run will continue with the missing chunks. At the end the chunks are
+    appended to the results table in a second pass (see merge_oeq_results).
+
+    Parameters
+    ----------
+    bzr : int or None
+        Code of a district region (Bezirksregion). Use None for Berlin.
+    chunk_size : int or None
+        Maximal number of buildings evaluated at once. Defaults to the
+        'chunk_size' of the 'oeq' section of the config file.
+    """
+    start = datetime.datetime.now()
+
+    filename_oeq_results = oeq_results_filename(bzr)
+    filename_alkis = artifacts.get("alkis_joined_table")
+
+    # Only the LOR codes of the whole table are read to find the rows of
+    # the region and to split them into chunks.
+    with pd.HDFStore(filename_alkis, mode="r") as store:
+        plr = pd.DataFrame({"PLR": store.select_column("alkis", "PLR")})
+    if bzr is None:
+        rows = np.arange(len(plr))
+    else:
+        rows = np.flatnonzero(get_bzr_codes(plr) == bzr)
+    if len(rows) == 0 and bzr is None:
+        raise ValueError("There are no buildings in the ALKIS table.")
+    elif len(rows) == 0:
+        raise ValueError(
+            "There are no buildings in district region {0}.".format(bzr)
+        )
+
+    sn_data = pd.read_csv(
+        os.path.join(cfg.get("paths", "data_berlin"), "data_by_blocktype.csv"),
+        ";",
+    )
 
-    # Calculate the heat demand of the building
-    logging.debug("Data types of the DataFrame: {0}".format(data.dtypes))
     logging.info("Calculate the heat demand of the buildings...")
 
     parameter = {"fraction_living_area": 0.8}
 
-    result = be.evaluate_building(data, **parameter)
+    if chunk_size is None:
+        chunk_size = cfg.get("oeq", "chunk_size")
+    if chunk_size is None:
+        chunk_size = len(rows)
+    chunks = [
+        np.sort(rows[c])
+        for c in get_lor_chunks(plr.PLR.iloc[rows], max(chunk_size, 1))
+    ]
+    del plr
+
+    chunk_file = filename_oeq_results + ".chunks"
+    info = pd.Series(
+        {
+            "chunk_size": chunk_size,
+            "buildings": len(rows),
+            "key": int(
+                artifacts.get_key("oeq_results", bzr=bzr)[:16], 16
+            ),
+        },
+        dtype=np.uint64,
+    )
+    mode = "a"
+    if os.path.isfile(chunk_file):
+        with pd.HDFStore(chunk_file, mode="r") as store:
+            if "info" not in store or not store["info"].equals(info):
+                logging.info("Chunk layout changed. Restart the evaluation.")
+                mode = "w"
+    with pd.HDFStore(chunk_file, mode=mode) as store:
+        store["info"] = info
+
+        for n, chunk in enumerate(chunks):
+            key = "chunk_{0}".format(n)
+            if key in store:
+                logging.debug("Skip finished chunk {0}.".format(n))
+                continue
+            logging.info(
+                "Chunk {0}/{1} ({2} buildings)".format(
+                    n + 1, len(chunks), len(chunk)
+                )
+            )
+            data = pd.DataFrame(
+                pd.read_hdf(filename_alkis, "alkis", where=chunk)
+            )
+            data = prepare_buildings(data, sn_data)
+            logging.debug("Data types: {0}".format(data.dtypes))
+            result = be.evaluate_building(data, **parameter)
+            result["my_total"] = result.total_loss_pres
+            store.put(key, apply_schema(result), format="table")
+            store.flush()
+            del data, result
+
+        store["year_of_construction"] = pd.Series(YEAR_OF_CONSTRUCTION)
+        store["parameter"] = pd.Series(parameter)
+
+    # The categories and string sizes of the whole table are collected from
+    # all chunks before they are appended to one table, which replaces the
+    # results file at once, so it is never incomplete.
+    logging.info("Store results to {0}".format(filename_oeq_results))
+    merge_oeq_results(
+        [chunk_file] * len(chunks),
+        filename_oeq_results,
+        keys=["chunk_{0}".format(n) for n in range(len(chunks))],
+    )
+    os.remove(chunk_file)
+    logging.warning("No date saved! Please add date to hdf5-file.")
+    logging.info("Elapsed time: {0}".format(datetime.datetime.now() - start))
+
+
+def _oeq_region(bzr):
+    return artifacts.get("oeq_results", bzr=bzr)
+
+
+def oeq_parallel(max_workers=None):
+    """Calculate the heat demand of Berlin in parallel by district regions.
 
-    result["my_total"] = result.total_loss_pres
+    The results of each district region (Bezirksregion) are calculated in a
+    process pool as artifacts of their own, so existing and valid region
+    files are reused. The upstream files have to be up to date before the
+    workers are started, otherwise they would be built by each worker.
 
-    str_cols = ["block", "block_type_name", "share_non_tilted_roof"]
-    result.loc[:, str_cols] = result[str_cols].applymap(str)
+    Parameters
+    ----------
+    max_workers : int or None
+        Number of processes. Defaults to the 'workers' of the 'oeq' section
+        of the config file or the number of processors if this is None.
+    """
+    start = datetime.datetime.now()
+    if max_workers is None:
+        max_workers = cfg.get("oeq", "workers")
+
+    regions = get_bzr_list()
+    if len(regions) == 0:
+        raise ValueError("There are no buildings in the ALKIS table.")
+    logging.info(
+        "Calculate the heat demand of {0} district regions.".format(
+            len(regions)
+        )
+    )
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        files = list(executor.map(_oeq_region, regions))
 
-    # Store results to hdf5 file
+    filename_oeq_results = oeq_results_filename()
     logging.info("Store results to {0}".format(filename_oeq_results))
-    store = pd.HDFStore(filename_oeq_results)
-    store["oeq"] = result
-    store["year_of_construction"] = pd.Series(year_of_construction)
-    store["parameter"] = pd.Series(parameter)
-    store.close()
-    logging.warning("No date saved! Please add date to hdf5-file.")
+    merge_oeq_results(files, filename_oeq_results)
     logging.info("Elapsed time: {0}".format(datetime.datetime.now() - start))
 
 
+def merge_oeq_results(files, filename, keys=None):
+    """Append the results of the district regions to one results file.
+
+    The files are read one after another, first to collect the categories
+    and string sizes of the whole table and then to append them to the table
+    of a temporary file, which replaces the results file at the end.
+
+    Parameters
+    ----------
+    files : list
+        Files with the results.
+    filename : str
+        Results file.
+    keys : list or None
+        Key of the results in each file. Defaults to 'oeq'.
+    """
+    if len(files) == 0:
+        raise ValueError(
+            "There are no results to merge into {0}.".format(filename)
+        )
+    if keys is None:
+        keys = ["oeq"] * len(files)
+    categories = {}
+    sizes = {}
+    for f, key in zip(files, keys):
+        result = pd.read_hdf(f, key)
+        for col, cat in get_categories(result).items():
+            categories[col] = cat.union(categories.get(col, cat))
+        for col, size in get_string_sizes(result).items():
+            sizes[col] = max(size, sizes.get(col, 0))
+        del result
+
+    part_file = filename + ".part"
+    with pd.HDFStore(part_file, mode="w") as store:
+        for f, key in zip(files, keys):
+            result = apply_schema(pd.read_hdf(f, key), categories=categories)
+            text = ["index"] + list(result.columns[result.dtypes == object])
+            store.append(
+                "oeq",
+                result,
+                format="table",
+                min_itemsize={k: v for k, v in sizes.items() if k in text}
+                if "oeq" not in store
+                else None,
+            )
+            del result
+        for key in ["year_of_construction", "parameter"]:
+            store[key] = pd.read_hdf(files[0], key)
+    os.replace(part_file, filename)
+
+
+def build_oeq_results(bzr=None):
+    """Builder of the 'oeq_results' artifact.
+
+    Berlin is calculated by district regions in parallel unless the number
+    of 'workers' in the 'oeq' section of the config file is 1.
+    """
+    if bzr is None and cfg.get("oeq", "workers") != 1:
+        oeq_parallel()
+    else:
+        oeq(bzr=bzr)
+
+
+def build_fis_broker_map(single):
+    """Builder of the 'fis_broker_map' artifact.
+
+    The tiles of an earlier download are only removed if the parameters of
+    the map have changed. If only the shapefile is missing (e.g. after an
+    interrupted run), the download continues with the existing tiles.
+    """
+    download.download_maps(
+        single=single,
+        overwrite=artifacts.is_changed("fis_broker_map", single=single),
+    )
+
+
+def fis_broker_filename(*args):
+    return os.path.join(cfg.get("paths", "fis_broker"), *args)
+
+
+def data_berlin_filename(section, key):
+    return os.path.join(cfg.get("paths", "data_berlin"), cfg.get(section, key))
+
+
+# Derived files of the ALKIS/OEQ chain (see berlin_hp.artifacts)
+ALKIS = "s_wfs_alkis_gebaeudeflaechen"
+
+artifacts.register(
+    "fis_broker_map",
+    filename=lambda single: fis_broker_filename(
+        cfg.get(single, "table"), "shp", cfg.get(single, "table") + ".shp"
+    ),
+    builder=build_fis_broker_map,
+    params=lambda single: cfg.get_dict(single),
+)
+artifacts.register(
+    "alkis_prepared",
+    filename=lambda: fis_broker_filename(
+        ALKIS, "shp", ALKIS + "_prepared.shp"
+    ),
+    builder=lambda: process_alkis_buildings(
+        fis_broker_filename(ALKIS, "shp", ALKIS + "_prepared.shp"), ALKIS
+    ),
+    depends=[("fis_broker_map", {"single": "alkis"})],
+    files=lambda: [data_berlin_filename("oeq", "alkis_heat_factor_table")],
+    params=lambda: {"remove_non_heated": True},
+)
+artifacts.register(
+    "alkis_joined_shp",
+    filename=lambda: fis_broker_filename(
+        cfg.get("fis_broker", "alkis_joined_shp")
+    ),
+    builder=merge_maps,
+    depends=["alkis_prepared"]
+    + [("fis_broker_map", {"single": t}) for t in ["block", "nutz", "ew"]],
+    files=lambda: [
+        data_berlin_filename("fis_broker", "heating_systems_csv")
+    ],
+    params=lambda: {
+        "max_block_distance": cfg.get("fis_broker", "max_block_distance")
+    },
+)
+artifacts.register(
+    "alkis_joined_table",
+    filename=lambda: fis_broker_filename(
+        cfg.get("fis_broker", "alkis_joined_hdf")
+    ),
+    builder=convert_shp2table,
+    depends=["alkis_joined_shp"],
+    params=lambda: {"data_columns": ["PLR"]},
+)
+artifacts.register(
+    "oeq_results",
+    filename=oeq_results_filename,
+    builder=build_oeq_results,
+    depends=["alkis_joined_table"],
+    files=lambda bzr=None: [
+        os.path.join(cfg.get("paths", "data_berlin"), "data_by_blocktype.csv")
+    ],
+)
+
+
 if __name__ == "__main__":
     logger.define_logging(file_level=logging.INFO)
     # oeq()
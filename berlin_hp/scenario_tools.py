@@ -10,9 +10,14 @@ __copyright__ = "Uwe Krien <krien@uni-bremen.de>"
 __license__ = "MIT"
 
 from collections import namedtuple
+from concurrent import futures
+import contextlib
+import datetime
 import logging
+import threading
 
 import numpy as np
+import pandas as pd
 
 # oemof libraries
 import oemof.tools.logger as logger
@@ -317,6 +322,129 @@ def check_input_data(data, section, ignore=None):
                 section, meta, list(c)))
 
 
+# Builder of a part of a table of the table collection. The function is
+# called with the results of the builders in 'depends'. Builders that read or
+# write hdf5 files have to set 'hdf' to True. The function has to be
+# picklable (e.g. functools.partial of a module function) to run a builder in
+# a process (see build_tables).
+TableBuilder = namedtuple(
+    'TableBuilder', ['table', 'function', 'depends', 'hdf'])
+TableBuilder.__new__.__defaults__ = (False,)
+
+# PyTables is not thread-safe, so only one builder of a process may use hdf5
+# files at once.
+HDF_LOCK = threading.Lock()
+
+
+def _timed(name, function, *args):
+    start = datetime.datetime.now()
+    result = function(*args)
+    logging.info("Table builder '{0}' finished: {1}".format(
+        name, datetime.datetime.now() - start))
+    return result
+
+
+def _locked(name, function, *args):
+    with HDF_LOCK:
+        return _timed(name, function, *args)
+
+
+def concat_time_series(parts):
+    """Concatenate the parts of a time series table column-wise.
+
+    The builders return different indexes for the same time steps (e.g. a
+    datetime index or a RangeIndex), so the parts are aligned by position
+    and get the index of the first part.
+    """
+    lengths = {len(part) for part in parts}
+    if len(lengths) > 1:
+        raise ValueError(
+            "The parts of the time series differ in length: {0}".format(
+                [len(part) for part in parts]))
+    index = parts[0].index
+    return pd.concat([part.set_axis(index, axis=0) for part in parts],
+                     axis=1)
+
+
+def build_tables(builders, max_workers=None, processes=None):
+    """Create a table collection from a graph of table builders.
+
+    Every builder is started as soon as the builders it depends on are
+    finished. The builders run in threads, but builders that use hdf5 files
+    run one after another (see HDF_LOCK), because PyTables is not
+    thread-safe. These are the expensive builders (feed-in, heat and
+    electricity demand), so without `processes` only the light builders
+    overlap with them. With `processes` the hdf5 builders run in a process
+    pool of this size instead, each with its own PyTables, so they overlap
+    as well. Their functions have to be picklable then and every process
+    loads the data of its builder (e.g. the building table) on its own.
+
+    The results of builders with the same table are concatenated
+    column-wise in the order of the builders. The parts of the
+    'time_series' table are aligned by position (see concat_time_series).
+
+    Parameters
+    ----------
+    builders : dict
+        TableBuilder of each node. The keys are the names of the nodes.
+    max_workers : int or None
+        Number of threads.
+    processes : int or None
+        Number of processes for the builders that use hdf5 files. If None
+        these builders run in threads one after another.
+
+    Returns
+    -------
+    dict : Table collection
+    """
+    results = {}
+    pending = dict(builders)
+    running = {}
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(
+            futures.ThreadPoolExecutor(max_workers=max_workers))
+        if processes:
+            process_executor = stack.enter_context(
+                futures.ProcessPoolExecutor(max_workers=processes))
+        else:
+            process_executor = None
+        while pending or running:
+            for name, builder in list(pending.items()):
+                if all(d in results for d in builder.depends):
+                    args = [results[d] for d in builder.depends]
+                    if builder.hdf and process_executor is not None:
+                        job = process_executor.submit(
+                            _timed, name, builder.function, *args)
+                    elif builder.hdf:
+                        job = executor.submit(
+                            _locked, name, builder.function, *args)
+                    else:
+                        job = executor.submit(
+                            _timed, name, builder.function, *args)
+                    running[job] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(
+                    "Unknown or circular dependencies: {0}".format(
+                        sorted(pending)))
+            done, _ = futures.wait(
+                running, return_when=futures.FIRST_COMPLETED)
+            for job in done:
+                results[running.pop(job)] = job.result()
+
+    table_collection = {}
+    for table in dict.fromkeys(b.table for b in builders.values()):
+        parts = [results[name] for name, b in builders.items()
+                 if b.table == table]
+        if len(parts) == 1:
+            table_collection[table] = parts[0]
+        elif table == 'time_series':
+            table_collection[table] = concat_time_series(parts)
+        else:
+            table_collection[table] = pd.concat(parts, axis=1)
+    return table_collection
+
+
 if __name__ == "__main__":
     # import pandas as pd
     logger.define_logging()